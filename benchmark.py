@@ -0,0 +1,250 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import numpy as np
+from PIL import Image
+
+from moonwalkcore import MoonWalkCore
+from moonwalkbatch import collect_images
+from stubmodel import StubModel
+from utils import detection_routine, filter_overlapping_detections_np, draw_bboxes, FullImage
+
+# decode is the reduced-size decode of the decode stage, decode_full the full-resolution one needed to draw
+STAGES = ('decode', 'encode', 'detect_class', 'detect_subclass', 'detect_crosswalk', 'filter', 'decode_full', 'draw', 'save')
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process in MB, or None where the resource module doesn't exist"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB, macOS bytes
+    return peak / 1024**2 if sys.platform == 'darwin' else peak / 1024
+
+
+def make_synthetic_corpus(folder, n_images, width, height, seed=0):
+    """Writes n_images deterministic noisy JPEGs to folder and returns their paths"""
+    rng = np.random.default_rng(seed)
+    paths = []
+    for i in range(n_images):
+        pixels = rng.integers(0, 256, size=(height, width, 3), dtype=np.uint8)
+        path = os.path.join(folder, f"synthetic_{i:04d}.jpg")
+        Image.fromarray(pixels).save(path, quality=90)
+        paths.append(path)
+    return paths
+
+
+def summarize(samples):
+    """p50/p95/mean latency in ms and throughput per second of a list of durations in seconds"""
+    if not samples:
+        return None
+    values = np.array(samples)
+    mean = float(values.mean())
+    return {
+        'n': len(samples),
+        'p50_ms': float(np.percentile(values, 50)) * 1000,
+        'p95_ms': float(np.percentile(values, 95)) * 1000,
+        'mean_ms': mean * 1000,
+        'throughput': 1.0 / mean if mean > 0 else None,
+    }
+
+
+def timed(samples, func, *args):
+    start_time = time.perf_counter()
+    result = func(*args)
+    samples.append(time.perf_counter() - start_time)
+    return result
+
+
+def run_benchmark(core, image_paths, max_dimensions, repeats=3, warmup=1):
+    """
+    Runs every stage of the pipeline on each image for every max dimension, timing each stage on its own.
+    The caches of the core are not used, so every repeat really runs the model.
+    Returns a dictionary {max_dimension: {stage: summary}} plus the per-image totals.
+    """
+    # The result images are only written to time the save stage
+    with tempfile.TemporaryDirectory(prefix="moonwalk_bench_") as output_folder:
+        results = {}
+        for max_dimension in max_dimensions:
+            core.max_dimension = max_dimension
+            samples = {stage: [] for stage in STAGES}
+            totals = []
+            for image_path in image_paths:
+                for repeat in range(warmup + repeats):
+                    stage_samples = {stage: [] for stage in STAGES}
+                    orig_image, image = timed(stage_samples['decode'], load_and_decode, core, image_path)
+                    if orig_image is None:
+                        break
+                    encoded_image = timed(stage_samples['encode'], core.model.encode_image, image)
+                    result_people = timed(stage_samples['detect_class'], detection_routine,
+                                          core.model, encoded_image, core.people_prompt, time, False)
+                    result_kids = timed(stage_samples['detect_subclass'], detection_routine,
+                                        core.model, encoded_image, core.kids_prompt, time, False)
+                    timed(stage_samples['detect_crosswalk'], detection_routine,
+                          core.model, encoded_image, core.crosswalk_prompt, time, False)
+                    img_width, img_height = orig_image.size
+                    result_adults = timed(stage_samples['filter'], filter_overlapping_detections_np,
+                                          result_people, result_kids, 0.5, img_width, img_height)
+                    orig_image = timed(stage_samples['decode_full'], decode_full, orig_image)
+                    result_image = timed(stage_samples['draw'], draw_bboxes,
+                                         orig_image, [result_adults, result_kids], [(0,0,255), (153,204,255)])
+                    output_path = os.path.join(output_folder, os.path.basename(image_path))
+                    timed(stage_samples['save'], result_image.save, output_path)
+
+                    if repeat >= warmup:
+                        for stage in STAGES:
+                            samples[stage].extend(stage_samples[stage])
+                        totals.append(sum(sum(values) for values in stage_samples.values()))
+
+            results[str(max_dimension)] = {stage: summarize(values) for stage, values in samples.items()}
+            results[str(max_dimension)]['image'] = summarize(totals)
+        return results
+
+
+def load_and_decode(core, image_path):
+    """Decode stage as the pipeline runs it (the full-resolution image is decoded later, see decode_full)"""
+    return core.load_image(image_path)
+
+
+def decode_full(orig_image):
+    """Full-resolution decode the pipeline does before drawing (a no-op if the decode stage already did it)"""
+    image = orig_image.full() if isinstance(orig_image, FullImage) else orig_image
+    image.load()
+    return image
+
+
+def compare_results(base, new, threshold=0.1, min_ms=1.0):
+    """
+    Compares two benchmark outputs and returns a list of regressions: stages whose p50 or p95 latency grew
+    more than threshold (a fraction) and more than min_ms (to ignore noise in very fast stages).
+    """
+    regressions = []
+    for max_dimension, stages in new['results'].items():
+        for stage, summary in stages.items():
+            base_summary = base['results'].get(max_dimension, {}).get(stage)
+            if summary is None or base_summary is None:
+                continue
+            for metric in ('p50_ms', 'p95_ms'):
+                old, current = base_summary[metric], summary[metric]
+                if current > old * (1 + threshold) and current - old > min_ms:
+                    regressions.append({
+                        'max_dimension': max_dimension,
+                        'stage': stage,
+                        'metric': metric,
+                        'base': old,
+                        'new': current,
+                        'change': (current - old) / old if old > 0 else None,
+                    })
+    base_rss, new_rss = base.get('peak_rss_mb'), new.get('peak_rss_mb')
+    if base_rss and new_rss and new_rss > base_rss * (1 + threshold):
+        regressions.append({'stage': 'peak_rss_mb', 'metric': 'peak_rss_mb', 'base': base_rss, 'new': new_rss,
+                            'change': (new_rss - base_rss) / base_rss})
+    return regressions
+
+
+def run_main(args):
+    parser = argparse.ArgumentParser(prog="benchmark.py run", description="Benchmark every stage of the detection pipeline")
+    parser.add_argument("inputs", nargs="*", help="Image files, directories or glob patterns of the corpus")
+    parser.add_argument("--synthetic", type=int, default=0, help="Number of synthetic images to generate as corpus")
+    parser.add_argument("--synthetic-size", type=int, nargs=2, default=[1920, 1080], help="Width and height of the synthetic images")
+    parser.add_argument("--model", default='models/moondream-2b-int8.mf', help="Path to the moondream model")
+    parser.add_argument("--stub", action="store_true", help="Use the deterministic stub model (no weights needed)")
+    parser.add_argument("--stub-encode-time", type=float, default=0.0, help="Seconds the stub model spends encoding")
+    parser.add_argument("--stub-detect-time", type=float, default=0.0, help="Seconds the stub model spends on each detect")
+    parser.add_argument("--max-dimensions", type=int, nargs="+", default=[248], help="Max dimensions to sweep")
+    parser.add_argument("--repeats", type=int, default=3, help="Timed runs of each image")
+    parser.add_argument("--warmup", type=int, default=1, help="Untimed runs of each image before the timed ones")
+    parser.add_argument("--output", default="benchmark.json", help="JSON file for the results")
+    opts = parser.parse_args(args)
+
+    # The synthetic corpus is removed at the end, like the result images
+    with tempfile.TemporaryDirectory(prefix="moonwalk_corpus_") as corpus_folder:
+        image_paths = collect_images(opts.inputs)
+        if opts.synthetic:
+            image_paths += make_synthetic_corpus(corpus_folder, opts.synthetic, *opts.synthetic_size)
+        if not image_paths:
+            print("No images found. Give a corpus or use --synthetic N.")
+            return 1
+
+        core = MoonWalkCore()
+        core.verbose = False
+        core.encode_cache = None
+        core.result_store = None
+
+        start_time = time.perf_counter()
+        if opts.stub:
+            core.model = StubModel(opts.stub_encode_time, opts.stub_detect_time)
+            core.model_name = "stub"
+        else:
+            core.model_path = opts.model
+            core.load_model()
+        load_time = time.perf_counter() - start_time
+
+        results = run_benchmark(core, image_paths, opts.max_dimensions, opts.repeats, opts.warmup)
+        report = {
+            'model': core.model_name,
+            'stub': opts.stub,
+            'corpus_size': len(image_paths),
+            'repeats': opts.repeats,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'load_model_s': load_time,
+            'peak_rss_mb': peak_rss_mb(),
+            'results': results,
+        }
+        with open(opts.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+        print(f"Model {core.model_name} loaded in {load_time:.2f} seconds")
+        for max_dimension, stages in results.items():
+            print(f"max_dimension={max_dimension}")
+            for stage, summary in stages.items():
+                if summary is not None:
+                    print(f"  {stage:<17} p50 {summary['p50_ms']:9.2f} ms  p95 {summary['p95_ms']:9.2f} ms  "
+                          f"{summary['throughput'] or 0:9.2f} /s")
+        print(f"Peak RSS: {report['peak_rss_mb']:.1f} MB" if report['peak_rss_mb'] else "Peak RSS: unknown")
+        print(f"Results saved to {opts.output}")
+        return 0
+
+
+def compare_main(args):
+    parser = argparse.ArgumentParser(prog="benchmark.py compare", description="Flag regressions between two benchmark runs")
+    parser.add_argument("base", help="JSON of the reference run")
+    parser.add_argument("new", help="JSON of the run to check")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Allowed slowdown as a fraction (0.1 = 10%%)")
+    parser.add_argument("--min-ms", type=float, default=1.0, help="Ignore slowdowns smaller than this")
+    opts = parser.parse_args(args)
+
+    with open(opts.base) as f:
+        base = json.load(f)
+    with open(opts.new) as f:
+        new = json.load(f)
+
+    regressions = compare_results(base, new, opts.threshold, opts.min_ms)
+    if not regressions:
+        print("No regressions found.")
+        return 0
+    for r in regressions:
+        where = f"max_dimension={r['max_dimension']} " if 'max_dimension' in r else ""
+        print(f"REGRESSION {where}{r['stage']} {r['metric']}: {r['base']:.2f} -> {r['new']:.2f} ({r['change']:+.0%})" if r['change'] is not None else
+              f"REGRESSION {where}{r['stage']} {r['metric']}: {r['base']:.2f} -> {r['new']:.2f}")
+    return 1
+
+
+def main(args):
+    commands = {'run': run_main, 'compare': compare_main}
+    if len(args) < 2 or args[1] not in commands:
+        print("Usage: python benchmark.py run|compare ...")
+        return 2
+    return commands[args[1]](args[2:])
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,68 @@
+import sys
+import time
+import random
+from utils import filter_overlapping_detections, filter_overlapping_detections_np, nms_detections, NUMPY_MIN_BOXES
+
+
+def random_detections(n, rng):
+    """Genera n detecciones normalizadas aleatorias"""
+    objects = []
+    for _ in range(n):
+        x_min = rng.random() * 0.9
+        y_min = rng.random() * 0.9
+        objects.append({
+            'x_min': x_min,
+            'y_min': y_min,
+            'x_max': min(1.0, x_min + rng.uniform(0.02, 0.2)),
+            'y_max': min(1.0, y_min + rng.uniform(0.05, 0.3)),
+        })
+    return {'objects': objects}
+
+
+def best_time(func, repeats):
+    """Best time of several runs of func"""
+    best = float('inf')
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start_time)
+    return best
+
+
+def main(args):
+    sizes = [int(a) for a in args[1:]] or [5, 20, 50, 200, 500]
+    rng = random.Random(0)
+    img_width, img_height = 4000, 3000
+
+    print(f"filter_overlapping_detections_np and nms_detections use the loop below {NUMPY_MIN_BOXES} boxes "
+          f"(class + subclass for the filter) and numpy from there on")
+    print(f"{'class':>6} {'subclass':>8} {'loop (ms)':>10} {'numpy (ms)':>11} {'speedup':>8} {'used':>6}"
+          f" {'nms loop (ms)':>14} {'nms numpy (ms)':>15} {'speedup':>8} {'used':>6}")
+    for n in sizes:
+        people = random_detections(n, rng)
+        kids = random_detections(max(1, n // 2), rng)
+
+        # min_boxes=0 forces the numpy path, min_boxes above n the loop
+        loop = lambda: filter_overlapping_detections(people, kids, 0.5, img_width, img_height)
+        numpy = lambda: filter_overlapping_detections_np(people, kids, 0.5, img_width, img_height, min_boxes=0)
+        nms_loop = lambda: nms_detections(people, 0.5, img_width, img_height, min_boxes=n + 1)
+        nms_numpy = lambda: nms_detections(people, 0.5, img_width, img_height, min_boxes=0)
+        if numpy() != loop():
+            raise AssertionError(f"Vectorized result differs from the loop for {n} boxes")
+        if nms_numpy() != nms_loop():
+            raise AssertionError(f"Vectorized NMS differs from the loop for {n} boxes")
+
+        repeats = 5 if n >= 200 else 50
+        loop_time = best_time(loop, repeats)
+        numpy_time = best_time(numpy, repeats)
+        nms_loop_time = best_time(nms_loop, repeats)
+        nms_numpy_time = best_time(nms_numpy, repeats)
+        used = 'loop' if n + len(kids['objects']) < NUMPY_MIN_BOXES else 'numpy'
+        nms_used = 'loop' if n < NUMPY_MIN_BOXES else 'numpy'
+        print(f"{n:>6} {len(kids['objects']):>8} {loop_time*1000:>10.3f} {numpy_time*1000:>11.3f} "
+              f"{loop_time/numpy_time:>7.1f}x {used:>6} {nms_loop_time*1000:>14.3f} {nms_numpy_time*1000:>15.3f} "
+              f"{nms_loop_time/nms_numpy_time:>7.1f}x {nms_used:>6}")
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,134 @@
+import traceback
+from PyQt5.QtCore import QObject, QRunnable, QThreadPool, pyqtSignal
+from utils import preview_image
+
+
+class DetectionSignals(QObject):
+    """Signals emitted by a DetectionJob (QRunnable can't emit signals by itself)"""
+    started = pyqtSignal(str)
+    progress = pyqtSignal(str, str)
+    finished = pyqtSignal(str, object)
+    error = pyqtSignal(str, str)
+
+
+class DetectionJob(QRunnable):
+    """
+    Runs MoonWalkCore.process_image over one image on a worker thread.
+    finished carries (output_path, n_people, n_kids, preview), where preview is the result rendered in memory
+    and downscaled here to preview_size, so the main thread never touches the full-resolution image.
+    The detection parameters (and the model, if the core has a registry) are captured when the job is created
+    and set on the core by run(), on the worker thread. Jobs run one at a time, so editing them in the UI
+    doesn't affect the running job nor the ones already queued.
+    """
+    def __init__(self, core, image_path, max_dimension, people_prompt, kids_prompt, model_name=None, preview_size=1024):
+        super().__init__()
+        self.core = core
+        self.image_path = image_path
+        self.max_dimension = max_dimension
+        self.people_prompt = people_prompt
+        self.kids_prompt = kids_prompt
+        self.model_name = model_name
+        self.preview_size = preview_size
+        self.cancelled = False
+        self.signals = DetectionSignals()
+        # The job queue keeps a reference to the job, so Qt must not delete it
+        self.setAutoDelete(False)
+
+    def run(self):
+        if self.cancelled:
+            return
+        self.signals.started.emit(self.image_path)
+        try:
+            if self.model_name is not None:
+                self.core.use_model(self.model_name)
+            self.core.max_dimension = self.max_dimension
+            self.core.people_prompt = self.people_prompt
+            self.core.kids_prompt = self.kids_prompt
+            output_path, detections = self.core.process_image(
+                self.image_path,
+                progress=lambda stage: self.signals.progress.emit(self.image_path, stage)
+            )
+            if detections is None:
+                self.signals.error.emit(self.image_path, "The file does not exist or is not a valid image")
+            else:
+                preview = preview_image(detections['result_image'], self.preview_size)
+                result = (output_path, detections['n_people'], detections['n_kids'], preview)
+                self.signals.finished.emit(self.image_path, result)
+        except Exception as e:
+            traceback.print_exc()
+            self.signals.error.emit(self.image_path, str(e))
+
+
+class ModelLoadSignals(QObject):
+    loaded = pyqtSignal(str, object)
+    error = pyqtSignal(str, str)
+
+
+class ModelLoadJob(QRunnable):
+    """
+    Loads a model of the registry on a background thread, so the GUI doesn't block while switching.
+    loaded carries the model name and its stats.
+    """
+    def __init__(self, registry, model_name):
+        super().__init__()
+        self.registry = registry
+        self.model_name = model_name
+        self.signals = ModelLoadSignals()
+
+    def run(self):
+        try:
+            self.registry.get(self.model_name)
+            self.signals.loaded.emit(self.model_name, self.registry.stats()[self.model_name])
+        except Exception as e:
+            traceback.print_exc()
+            self.signals.error.emit(self.model_name, str(e))
+
+
+class DetectionQueue(QObject):
+    """
+    Queue of detection jobs run one at a time on a background thread,
+    so the model never blocks the Qt main thread.
+    """
+    changed = pyqtSignal(int)
+
+    def __init__(self, core, parent=None):
+        super().__init__(parent)
+        self.core = core
+        self.pool = QThreadPool()
+        # The model runs one image at a time
+        self.pool.setMaxThreadCount(1)
+        self.pending = []
+        self.running = None
+
+    def submit(self, image_path, max_dimension, people_prompt, kids_prompt, model_name=None, preview_size=1024):
+        """Queues a detection job and returns it, so the caller can connect to its signals"""
+        job = DetectionJob(self.core, image_path, max_dimension, people_prompt, kids_prompt, model_name, preview_size)
+        job.signals.started.connect(lambda _path, job=job: self._start(job))
+        job.signals.finished.connect(lambda _path, _result, job=job: self._done(job))
+        job.signals.error.connect(lambda _path, _message, job=job: self._done(job))
+        self.pending.append(job)
+        self.pool.start(job)
+        self.changed.emit(len(self.pending))
+        return job
+
+    def _start(self, job):
+        if job in self.pending:
+            self.pending.remove(job)
+        self.running = job
+        self.changed.emit(len(self.pending))
+
+    def _done(self, job):
+        if self.running is job:
+            self.running = None
+        self.changed.emit(len(self.pending))
+
+    def cancel_pending(self):
+        """Cancels every job that hasn't started yet. The running job can't be interrupted"""
+        for job in self.pending:
+            job.cancelled = True
+        self.pool.clear()
+        self.pending = []
+        self.changed.emit(0)
+
+    def is_busy(self):
+        return self.running is not None or bool(self.pending)
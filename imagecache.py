@@ -0,0 +1,109 @@
+import os
+import pickle
+import threading
+from collections import OrderedDict
+
+
+def encoded_size(encoded_image):
+    """
+    Returns the approximate size in bytes of an encoded image.
+    Local moondream models keep the image as a numpy kv cache, anything else is measured pickled.
+    """
+    kv_cache = getattr(encoded_image, 'kv_cache', None)
+    if kv_cache is not None and hasattr(kv_cache, 'nbytes'):
+        return int(kv_cache.nbytes)
+    return len(pickle.dumps(encoded_image, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+class EncodedImageCache():
+    """
+    LRU cache of encoded images with a byte budget.
+    Entries evicted from memory are spilled to spill_folder (if set) and promoted back on the next hit.
+
+    Args:
+    max_bytes: Memory budget for the in-memory entries
+    spill_folder: Folder for the on-disk spill. None disables the spill
+    max_spill_bytes: Disk budget for the spill folder (oldest files are removed first)
+    """
+    def __init__(self, max_bytes=256 * 1024**2, spill_folder=None, max_spill_bytes=8 * 1024**3):
+        self.max_bytes = max_bytes
+        self.spill_folder = spill_folder
+        self.max_spill_bytes = max_spill_bytes
+        self.current_bytes = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        if self.spill_folder:
+            os.makedirs(self.spill_folder, exist_ok=True)
+
+    def _spill_path(self, key):
+        return os.path.join(self.spill_folder, f"{key}.pkl")
+
+    def get(self, key):
+        """Returns the encoded image for key, or None if it is not cached"""
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key][0]
+
+        if not self.spill_folder:
+            return None
+        spill_path = self._spill_path(key)
+        try:
+            with open(spill_path, 'rb') as f:
+                encoded_image = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+        try:
+            os.remove(spill_path)
+        except OSError:
+            pass
+        self.put(key, encoded_image)
+        return encoded_image
+
+    def put(self, key, encoded_image):
+        """Stores an encoded image, evicting the least recently used entries over the budget"""
+        size = encoded_size(encoded_image)
+        if size > self.max_bytes:
+            self._spill(key, encoded_image)
+            return
+
+        evicted = []
+        with self.lock:
+            if key in self.entries:
+                self.current_bytes -= self.entries.pop(key)[1]
+            self.entries[key] = (encoded_image, size)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                old_key, (old_image, old_size) = self.entries.popitem(last=False)
+                self.current_bytes -= old_size
+                evicted.append((old_key, old_image))
+
+        for old_key, old_image in evicted:
+            self._spill(old_key, old_image)
+
+    def _spill(self, key, encoded_image):
+        """Writes an evicted entry to the spill folder and trims the folder to its budget"""
+        if not self.spill_folder:
+            return
+        tmp_path = self._spill_path(key) + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(encoded_image, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self._spill_path(key))
+
+        spilled = [os.path.join(self.spill_folder, f) for f in os.listdir(self.spill_folder) if f.endswith('.pkl')]
+        spilled.sort(key=os.path.getmtime)
+        total = sum(os.path.getsize(f) for f in spilled)
+        while spilled and total > self.max_spill_bytes:
+            oldest = spilled.pop(0)
+            total -= os.path.getsize(oldest)
+            os.remove(oldest)
+
+    def clear(self):
+        """Removes every entry from memory and from the spill folder"""
+        with self.lock:
+            self.entries.clear()
+            self.current_bytes = 0
+        if self.spill_folder:
+            for f in os.listdir(self.spill_folder):
+                if f.endswith('.pkl'):
+                    os.remove(os.path.join(self.spill_folder, f))
@@ -0,0 +1,168 @@
+import os
+import json
+import time
+import threading
+
+# Upper bounds (seconds) of the latency histogram buckets
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Tags used as Prometheus labels. The rest (like the image size) only go to the trace
+LABEL_TAGS = ('prompt', 'model')
+
+# Fallback start time of process_uptime where /proc is not available
+_IMPORT_TIME = time.time()
+
+
+def process_uptime():
+    """
+    Seconds since this process started, to report cold start times (interpreter startup included).
+    Where /proc is not available, seconds since this module was imported.
+    """
+    try:
+        with open('/proc/self/stat') as f:
+            # The command name may contain spaces, the fields after it don't
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            system_uptime = float(f.read().split()[0])
+        return max(0.0, system_uptime - start_ticks / os.sysconf('SC_CLK_TCK'))
+    except (OSError, ValueError, IndexError):
+        return time.time() - _IMPORT_TIME
+
+
+class _NullSpan():
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class NullInstrumentation():
+    """Instrumentation that records nothing. span() always returns the same no-op context manager"""
+    enabled = False
+
+    def span(self, name, **tags):
+        return _NULL_SPAN
+
+    def close(self):
+        pass
+
+
+class Histogram():
+    """Cumulative latency histogram in the Prometheus style"""
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            yield bound, total
+
+
+class _Span():
+    __slots__ = ('instrumentation', 'name', 'tags', 'start')
+
+    def __init__(self, instrumentation, name, tags):
+        self.instrumentation = instrumentation
+        self.name = name
+        self.tags = tags
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration = time.perf_counter() - self.start
+        self.instrumentation.record(self.name, duration, self.tags, error=exc_type is not None)
+        return False
+
+
+class Instrumentation():
+    """
+    Records spans of the pipeline stages (load, decode, resize, encode, detect, filter, draw, save).
+    Durations go to in-process histograms labelled by stage, prompt and model, which can be exported
+    as a Prometheus text file. If trace_path is set, every span is also appended to it as a JSON line.
+
+    Args:
+    trace_path: JSONL file for the trace. None disables the trace
+    buckets: Upper bounds in seconds of the histogram buckets
+    """
+    enabled = True
+
+    def __init__(self, trace_path=None, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.histograms = {}
+        self.lock = threading.Lock()
+        self.trace_file = open(trace_path, 'a', buffering=1) if trace_path else None
+
+    def span(self, name, **tags):
+        """Context manager that times the block as a span of stage name"""
+        return _Span(self, name, tags)
+
+    def record(self, name, duration, tags, error=False):
+        labels = (name,) + tuple(str(tags.get(tag, '')) for tag in LABEL_TAGS)
+        with self.lock:
+            histogram = self.histograms.get(labels)
+            if histogram is None:
+                histogram = self.histograms[labels] = Histogram(self.buckets)
+            histogram.observe(duration)
+            if self.trace_file is not None:
+                event = {'span': name, 'ts': time.time() - duration, 'duration': duration,
+                         'thread': threading.current_thread().name, 'error': error}
+                event.update(tags)
+                self.trace_file.write(json.dumps(event) + "\n")
+
+    def summary(self):
+        """Returns {(stage, prompt, model): (count, mean seconds)}"""
+        with self.lock:
+            return {labels: (h.count, h.sum / h.count) for labels, h in self.histograms.items() if h.count}
+
+    def prometheus_text(self):
+        """Histograms in the Prometheus text exposition format"""
+        lines = [
+            "# HELP moonwalk_stage_seconds Latency of the moonwalk pipeline stages",
+            "# TYPE moonwalk_stage_seconds histogram",
+        ]
+        with self.lock:
+            for labels, histogram in sorted(self.histograms.items()):
+                label_text = ",".join(f'{key}="{_escape(value)}"' for key, value in zip(('stage',) + LABEL_TAGS, labels))
+                for bound, count in histogram.cumulative():
+                    lines.append(f'moonwalk_stage_seconds_bucket{{{label_text},le="{bound}"}} {count}')
+                lines.append(f'moonwalk_stage_seconds_bucket{{{label_text},le="+Inf"}} {histogram.count}')
+                lines.append(f'moonwalk_stage_seconds_sum{{{label_text}}} {histogram.sum}')
+                lines.append(f'moonwalk_stage_seconds_count{{{label_text}}} {histogram.count}')
+        return "\n".join(lines) + "\n"
+
+    def export_prometheus(self, path):
+        """Writes the histograms to a Prometheus text file (atomically, for the node exporter textfile collector)"""
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(self.prometheus_text())
+        os.replace(tmp_path, path)
+
+    def close(self):
+        with self.lock:
+            if self.trace_file is not None:
+                self.trace_file.close()
+                self.trace_file = None
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -1,19 +1,27 @@
 import sys
+import argparse
 from moonkwalkui import MoonWalkUI
 from PyQt5.QtWidgets import QApplication
+from instrumentation import process_uptime
 
 def main(args):
-    model_path='models/moondream-2b-int8.mf'
-    if len(args) > 1:
-        model_path = args[1]
+    parser = argparse.ArgumentParser(description="MoonWalk GUI")
+    parser.add_argument("model", nargs="?", default='models/moondream-2b-int8.mf', help="Path to the moondream model")
+    parser.add_argument("--memory-budget", type=float,
+                        help="Max MB of resident models (least recently used ones are evicted). Half of the memory by default")
+    # The rest of the arguments are left to Qt
+    opts, _ = parser.parse_known_args(args[1:])
+    model_path = opts.model
     
     print(f"Using model path: {model_path}")
     
     app = QApplication(sys.argv)
     app.setStyle('Fusion')
     
-    window = MoonWalkUI(model_path)
+    window = MoonWalkUI(model_path, opts.memory_budget * 1024**2 if opts.memory_budget else None)
     window.show()
+    # The model is still loading in the background
+    print(f"Window shown {process_uptime():.2f} seconds after start.")
     
     sys.exit(app.exec())
 
@@ -1,18 +1,514 @@
+import os
 import sys
-from moonwalkcore import MoonWalkCore
+import time
+import argparse
+import threading
+from concurrent.futures import Future
+from instrumentation import process_uptime
+
+# Every subcommand imports what it needs (the core pulls numpy, PIL and moondream),
+# so the interactive mode can show its prompt before any of them is loaded
+
+DEFAULT_MODEL_PATH = 'models/moondream-2b-int8.mf'
+
+
+def batch_main(args):
+    from moonwalkcore import MoonWalkCore
+    from moonwalkbatch import MoonWalkBatch, collect_images
+    from resultexport import JsonlSink
+    from taxonomy import load_taxonomy
+    from instrumentation import Instrumentation
+    from resultstore import DetectionStore
+    parser = argparse.ArgumentParser(prog="main_console.py batch", description="Run the detection over many images")
+    parser.add_argument("inputs", nargs="+", help="Image files, directories or glob patterns")
+    parser.add_argument("--model", default=DEFAULT_MODEL_PATH, help="Path to the moondream model")
+    parser.add_argument("--class-prompt", default="humans", help="Prompt for human/class detection")
+    parser.add_argument("--subclass-prompt", default="kids", help="Prompt for kids/subclass detection")
+    parser.add_argument("--max-dimension", type=int, default=248, help="Max dimension of the resized image")
+    parser.add_argument("--concurrent-prompts", action="store_true", help="Run every prompt of an image at once")
+    parser.add_argument("--taxonomy", help="JSON or YAML tree of prompts to run instead of the class/subclass prompts")
+    parser.add_argument("--tiled", action="store_true", help="Detect on overlapping tiles of the original image")
+    parser.add_argument("--tile-size", type=int, default=1024, help="Side of each tile in original pixels")
+    parser.add_argument("--tile-overlap", type=float, default=0.2, help="Fraction of each tile shared with the next one")
+    parser.add_argument("--tile-workers", type=int, default=2, help="Tiles encoded and detected at once")
+    parser.add_argument("--adaptive", action="store_true",
+                        help="Detect at the smallest size of --ladder first and escalate to the next ones only when uncertain")
+    parser.add_argument("--ladder", type=int, nargs="+", default=[248, 496, 992], help="Max dimensions of the adaptive mode")
+    parser.add_argument("--escalate-people", type=int, default=8, help="Escalate when at least this many people are found (0 disables)")
+    parser.add_argument("--escalate-box-pixels", type=int, default=12,
+                        help="Escalate when a box is smaller than this in the resized image (0 disables)")
+    parser.add_argument("--no-escalate-disagreement", action="store_true",
+                        help="Don't escalate when some kids don't overlap any of the people")
+    parser.add_argument("--roi-cascade", action="store_true",
+                        help="Detect the crosswalk once per folder and run the people prompts on a crop around it")
+    parser.add_argument("--roi-dimension", type=int, default=248, help="Max dimension used to find the crosswalk")
+    parser.add_argument("--roi-margin", type=float, default=0.3, help="Fraction of the crosswalk size added around it")
+    parser.add_argument("--dedup", action="store_true",
+                        help="Reuse the detections of the previous image of the same folder when they are near-duplicates")
+    parser.add_argument("--dedup-threshold", type=int, default=6, help="Max perceptual hash bits (of 64) that can differ")
+    parser.add_argument("--queue-size", type=int, default=8, help="Max images waiting between two stages")
+    parser.add_argument("--metrics-file", help="Prometheus text file for the stage latency histograms")
+    parser.add_argument("--trace-file", help="JSONL file for a trace of every stage")
+    parser.add_argument("--render", choices=['full', 'preview', 'inplace'], default='full',
+                        help="Draw the boxes on a full-resolution copy, on a downscaled preview or on the original image")
+    parser.add_argument("--preview-size", type=int, default=1024, help="Max dimension of the preview images")
+    parser.add_argument("--no-save", action="store_true", help="Don't save the result images")
+    parser.add_argument("--async-save", action="store_true", help="Save the result images on background threads")
+    parser.add_argument("--decode-workers", type=int, default=2, help="Threads decoding and resizing images")
+    parser.add_argument("--save-workers", type=int, default=2, help="Threads drawing and saving results")
+    parser.add_argument("--export", help="JSONL file where a record with the boxes and timings of every image is appended")
+    parser.add_argument("--resume", action="store_true", help="Skip the images already in the --export file")
+    parser.add_argument("--fsync-every", type=int, default=100, help="Export records between two fsyncs")
+    parser.add_argument("--store", help="SQLite file where detection results are stored and reused (off by default)")
+    opts = parser.parse_args(args)
+    if not 0 <= opts.tile_overlap < 1:
+        parser.error("--tile-overlap must be at least 0 and below 1")
+
+    image_paths = collect_images(opts.inputs)
+    if not image_paths:
+        print("No images found.")
+        return
+
+    sink = None
+    if opts.export:
+        sink = JsonlSink(opts.export, fsync_every=opts.fsync_every)
+        if opts.resume:
+            finished = sink.finished_paths()
+            image_paths = [p for p in image_paths if os.path.abspath(p) not in finished]
+            print(f"Resuming: {len(finished)} images already exported, {len(image_paths)} left.")
+    elif opts.resume:
+        print("--resume needs an --export file.")
+        return
+
+    core = MoonWalkCore()
+    core.model_path = opts.model
+    core.load_model()
+    core.people_prompt = opts.class_prompt
+    core.kids_prompt = opts.subclass_prompt
+    core.max_dimension = opts.max_dimension
+    core.concurrent_prompts = opts.concurrent_prompts
+    if opts.taxonomy:
+        core.taxonomy = load_taxonomy(opts.taxonomy)
+    core.tiled = opts.tiled
+    core.tile_size = opts.tile_size
+    core.tile_overlap = opts.tile_overlap
+    core.tile_workers = opts.tile_workers
+    core.adaptive = opts.adaptive
+    core.resolution_ladder = opts.ladder
+    core.escalate_min_people = opts.escalate_people
+    core.escalate_min_box_pixels = opts.escalate_box_pixels
+    core.escalate_on_disagreement = not opts.no_escalate_disagreement
+    core.roi_cascade = opts.roi_cascade
+    core.dedup = opts.dedup
+    core.dedup_threshold = opts.dedup_threshold
+    core.roi_dimension = opts.roi_dimension
+    core.roi_margin = opts.roi_margin
+    core.render_mode = opts.render
+    core.preview_size = opts.preview_size
+    core.save_results = not opts.no_save
+    core.async_save = opts.async_save
+    # Every image is run once, so the encoded images would never be reused
+    core.encode_cache = None
+    if opts.store:
+        core.result_store = DetectionStore(opts.store)
+    core.verbose = False
+    if opts.metrics_file or opts.trace_file:
+        core.instrumentation = Instrumentation(opts.trace_file)
+
+    print(f"Processing {len(image_paths)} images...")
+    batch = MoonWalkBatch(core, queue_size=opts.queue_size,
+                          decode_workers=opts.decode_workers, save_workers=opts.save_workers, sink=sink)
+    try:
+        batch.run(image_paths)
+    finally:
+        if sink is not None:
+            sink.close()
+        if core.result_store is not None:
+            core.result_store.close()
+    batch.print_stats()
+    if sink is not None:
+        print(f"Records appended to {opts.export}")
+    if opts.metrics_file:
+        core.instrumentation.export_prometheus(opts.metrics_file)
+        print(f"Metrics saved to {opts.metrics_file}")
+    core.instrumentation.close()
+
+
+def compare_tiling_main(args):
+    from moonwalkcore import MoonWalkCore
+    from moonwalkbatch import collect_images
+    from tiling import compare_tiling
+    parser = argparse.ArgumentParser(prog="main_console.py compare-tiling",
+                                     description="Compare one big resize against tiled detection")
+    parser.add_argument("inputs", nargs="+", help="Image files, directories or glob patterns")
+    parser.add_argument("--model", default=DEFAULT_MODEL_PATH, help="Path to the moondream model")
+    parser.add_argument("--max-dimension", type=int, default=248, help="Max dimension of the resized image and of each tile")
+    parser.add_argument("--tile-size", type=int, default=1024, help="Side of each tile in original pixels")
+    parser.add_argument("--tile-overlap", type=float, default=0.2, help="Fraction of each tile shared with the next one")
+    parser.add_argument("--tile-workers", type=int, default=2, help="Tiles encoded and detected at once")
+    opts = parser.parse_args(args)
+    if not 0 <= opts.tile_overlap < 1:
+        parser.error("--tile-overlap must be at least 0 and below 1")
+
+    image_paths = collect_images(opts.inputs)
+    if not image_paths:
+        print("No images found.")
+        return
+
+    core = MoonWalkCore()
+    core.model_path = opts.model
+    core.load_model()
+    core.max_dimension = opts.max_dimension
+    core.tile_size = opts.tile_size
+    core.tile_overlap = opts.tile_overlap
+    core.tile_workers = opts.tile_workers
+    core.verbose = False
+
+    rows = compare_tiling(core, image_paths)
+    print(f"{'image':<30} {'resize (s)':>10} {'people':>6} {'kids':>5} {'tiled (s)':>10} {'people':>6} {'kids':>5} {'agreement':>9}")
+    for row in rows:
+        print(f"{os.path.basename(row['image'])[:30]:<30} {row['resize_time']:>10.2f} {row['resize_people']:>6} {row['resize_kids']:>5} "
+              f"{row['tiled_time']:>10.2f} {row['tiled_people']:>6} {row['tiled_kids']:>5} {row['agreement']:>9.2f}")
+    if rows:
+        resize_time = sum(row['resize_time'] for row in rows) / len(rows)
+        tiled_time = sum(row['tiled_time'] for row in rows) / len(rows)
+        print(f"Mean time: resize {resize_time:.2f} s, tiled {tiled_time:.2f} s")
+
+
+def serve_main(args):
+    from moonwalkcore import MoonWalkCore
+    from modelregistry import ModelRegistry
+    from stubmodel import StubModel
+    from instrumentation import Instrumentation
+    from resultstore import DetectionStore
+    from resultexport import JsonlSink
+    from moonwalkserver import MoonWalkServer, DEFAULT_HOST, DEFAULT_PORT
+    parser = argparse.ArgumentParser(prog="main_console.py serve", description="Keep the model loaded and serve detections")
+    parser.add_argument("--model", default=DEFAULT_MODEL_PATH, help="Path to the moondream model")
+    parser.add_argument("--stub", action="store_true", help="Use a deterministic stub model instead of the .mf file")
+    parser.add_argument("--host", default=DEFAULT_HOST, help="Address to listen on")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="Port to listen on")
+    parser.add_argument("--queue-size", type=int, default=64, help="Max requests waiting for the model")
+    parser.add_argument("--coalesce-size", type=int, default=8,
+                        help="Max requests gathered to run identical ones only once (there is no batching: each image is one model call)")
+    parser.add_argument("--coalesce-wait", type=float, default=0.01, help="Seconds to wait for identical requests to coalesce")
+    parser.add_argument("--request-timeout", type=float, default=300,
+                        help="Seconds a request waits for its result before the server answers 504")
+    parser.add_argument("--trace-file", help="JSONL file for a trace of every stage")
+    parser.add_argument("--models-folder", default=os.path.dirname(DEFAULT_MODEL_PATH),
+                        help="Folder with the models requests can switch to")
+    parser.add_argument("--memory-budget", type=float, help="Max MB of resident models (least recently used ones are evicted)")
+    parser.add_argument("--export", help="JSONL file where a record of every detection run is appended")
+    parser.add_argument("--store", help="SQLite file where detection results are stored and reused (off by default)")
+    opts = parser.parse_args(args)
+
+    core = MoonWalkCore()
+    # The latency histograms are served on GET /metrics
+    core.instrumentation = Instrumentation(opts.trace_file)
+    if not opts.stub:
+        budget = opts.memory_budget * 1024**2 if opts.memory_budget else None
+        core.registry = ModelRegistry(opts.models_folder, budget)
+    if opts.stub:
+        core.model = StubModel()
+        core.model_name = "stub"
+    else:
+        core.model_path = opts.model
+        core.load_model()
+    if opts.store:
+        core.result_store = DetectionStore(opts.store)
+    core.verbose = False
+
+    sink = JsonlSink(opts.export) if opts.export else None
+    server = MoonWalkServer(core, opts.host, opts.port, opts.queue_size, opts.coalesce_size, opts.coalesce_wait,
+                            opts.request_timeout, sink)
+    try:
+        server.serve_forever()
+    finally:
+        if sink is not None:
+            sink.close()
+        if core.result_store is not None:
+            core.result_store.close()
+
+
+def client_main(args):
+    from moonwalkbatch import collect_images
+    from moonwalkserver import MoonWalkClient, DEFAULT_HOST, DEFAULT_PORT
+    parser = argparse.ArgumentParser(prog="main_console.py client", description="Send detections to a running server")
+    parser.add_argument("inputs", nargs="+", help="Image files, directories or glob patterns")
+    parser.add_argument("--url", default=f"http://{DEFAULT_HOST}:{DEFAULT_PORT}", help="URL of the server")
+    parser.add_argument("--class-prompt", default="humans", help="Prompt for human/class detection")
+    parser.add_argument("--subclass-prompt", default="kids", help="Prompt for kids/subclass detection")
+    parser.add_argument("--max-dimension", type=int, default=248, help="Max dimension of the resized image")
+    parser.add_argument("--model", help="Model of the server to use, or 'fastest'")
+    opts = parser.parse_args(args)
+
+    client = MoonWalkClient(opts.url)
+    for image_path in collect_images(opts.inputs):
+        try:
+            output_path, n_people, n_kids, _ = client.detect(
+                image_path, opts.class_prompt, opts.subclass_prompt, opts.max_dimension, opts.model)
+            print(f"{image_path}: {n_people} {opts.class_prompt}, {n_kids} {opts.subclass_prompt} -> {output_path}")
+        except RuntimeError as e:
+            print(f"{image_path}: error: {str(e)}")
+        except ConnectionError as e:
+            print(f"Error: {str(e)}")
+            return
+
+
+def pool_main(args):
+    from moonwalkbatch import collect_images
+    from moonwalkpool import MoonWalkPool
+    from resultexport import JsonlSink
+    parser = argparse.ArgumentParser(prog="main_console.py pool", description="Run the detection on a pool of processes")
+    parser.add_argument("inputs", nargs="+", help="Image files, directories or glob patterns")
+    parser.add_argument("--model", default=DEFAULT_MODEL_PATH, help="Path to the moondream model")
+    parser.add_argument("--stub", action="store_true", help="Use a deterministic stub model instead of the .mf file")
+    parser.add_argument("--workers", type=int, default=2, help="Worker processes, each one with its own model")
+    parser.add_argument("--threads-per-worker", type=int, default=1, help="Cores given to each worker")
+    parser.add_argument("--class-prompt", default="humans", help="Prompt for human/class detection")
+    parser.add_argument("--subclass-prompt", default="kids", help="Prompt for kids/subclass detection")
+    parser.add_argument("--max-dimension", type=int, default=248, help="Max dimension of the resized image")
+    parser.add_argument("--export", help="JSONL file where a record with the boxes and timings of every image is appended")
+    parser.add_argument("--resume", action="store_true", help="Skip the images already in the --export file")
+    opts = parser.parse_args(args)
+
+    image_paths = collect_images(opts.inputs)
+    if not image_paths:
+        print("No images found.")
+        return
+
+    sink = None
+    if opts.export:
+        sink = JsonlSink(opts.export)
+        if opts.resume:
+            finished = sink.finished_paths()
+            image_paths = [p for p in image_paths if os.path.abspath(p) not in finished]
+            print(f"Resuming: {len(finished)} images already exported, {len(image_paths)} left.")
+    elif opts.resume:
+        print("--resume needs an --export file.")
+        return
+
+    pool = MoonWalkPool(opts.model, opts.workers, opts.threads_per_worker, stub=opts.stub, core_settings={
+        'people_prompt': opts.class_prompt,
+        'kids_prompt': opts.subclass_prompt,
+        'max_dimension': opts.max_dimension,
+    }, export=sink is not None)
+    print(f"Processing {len(image_paths)} images on {opts.workers} workers...")
+    start_time = time.time()
+    n_done = 0
+    try:
+        for result in pool.imap(image_paths):
+            if 'error' in result:
+                print(f"{result['image_path']}: error: {result['error']}")
+            else:
+                n_done += 1
+                print(f"{result['image_path']}: {result['n_people']} {opts.class_prompt}, {result['n_kids']} {opts.subclass_prompt}")
+                if sink is not None:
+                    sink.write(result['record'])
+    finally:
+        pool.close()
+        if sink is not None:
+            sink.close()
+    elapsed = time.time() - start_time
+    print(f"Processed {n_done} images in {elapsed:.2f} seconds ({n_done/elapsed:.2f} images/s, {pool.restarts} worker restarts)")
+
+
+def stream_main(args):
+    from moonwalkcore import MoonWalkCore
+    from stubmodel import StubModel
+    from moonwalkstream import MoonWalkStream
+    parser = argparse.ArgumentParser(prog="main_console.py stream", description="Detect and track people in a video or a folder of frames")
+    parser.add_argument("source", help="Video file or folder of numbered frames")
+    parser.add_argument("--model", default=DEFAULT_MODEL_PATH, help="Path to the moondream model")
+    parser.add_argument("--stub", action="store_true", help="Use a deterministic stub model instead of the .mf file")
+    parser.add_argument("--class-prompt", default="humans", help="Prompt for human/class detection")
+    parser.add_argument("--subclass-prompt", default="kids", help="Prompt for kids/subclass detection")
+    parser.add_argument("--max-dimension", type=int, default=248, help="Max dimension of the resized frames")
+    parser.add_argument("--every", type=int, default=10, help="Frames between two full detections")
+    parser.add_argument("--scene-threshold", type=float, default=0.15,
+                        help="Frame difference (0-1) that forces a detection, negative disables it")
+    parser.add_argument("--iou", type=float, default=0.3, help="Min IoU to match a detection to a track")
+    parser.add_argument("--fps", type=float, default=25.0, help="Frame rate of a folder of frames")
+    parser.add_argument("--output", help="JSONL file with a record per frame (default: <source>_tracks.jsonl)")
+    parser.add_argument("--annotated", help="Video file or folder for the frames with their tracked boxes")
+    opts = parser.parse_args(args)
+
+    core = MoonWalkCore()
+    if opts.stub:
+        core.model = StubModel()
+        core.model_name = "stub"
+    else:
+        core.model_path = opts.model
+        core.load_model()
+    core.people_prompt = opts.class_prompt
+    core.kids_prompt = opts.subclass_prompt
+    core.max_dimension = opts.max_dimension
+    # Frames are not files, so there is nothing to key the caches with
+    core.encode_cache = None
+    core.result_store = None
+    core.verbose = False
+
+    output_path = opts.output or os.path.splitext(opts.source.rstrip(os.sep))[0] + "_tracks.jsonl"
+    scene_threshold = opts.scene_threshold if opts.scene_threshold >= 0 else None
+    stream = MoonWalkStream(core, opts.every, scene_threshold, opts.iou)
+    stream.run(opts.source, output_path, opts.annotated, opts.fps)
+    stream.print_stats()
+    print(f"Tracks saved to {output_path}")
+
+
+def watch_main(args):
+    from moonwalkcore import MoonWalkCore
+    from stubmodel import StubModel
+    from resultexport import JsonlSink
+    from resultstore import DetectionStore
+    from moonwalkwatch import MoonWalkWatcher
+    parser = argparse.ArgumentParser(prog="main_console.py watch", description="Detect every new image dropped in a folder")
+    parser.add_argument("folder", help="Folder to watch")
+    parser.add_argument("--model", default=DEFAULT_MODEL_PATH, help="Path to the moondream model")
+    parser.add_argument("--stub", action="store_true", help="Use a deterministic stub model instead of the .mf file")
+    parser.add_argument("--class-prompt", default="humans", help="Prompt for human/class detection")
+    parser.add_argument("--subclass-prompt", default="kids", help="Prompt for kids/subclass detection")
+    parser.add_argument("--max-dimension", type=int, default=248, help="Max dimension of the resized image")
+    parser.add_argument("--queue-size", type=int, default=32, help="Max images waiting for the model")
+    parser.add_argument("--policy", choices=['block', 'drop-oldest'], default='block',
+                        help="What to do with new images when the queue is full")
+    parser.add_argument("--settle-time", type=float, default=1.0, help="Seconds a file must stay unchanged before it is read")
+    parser.add_argument("--poll", action="store_true", help="Poll the folder instead of using inotify")
+    parser.add_argument("--poll-interval", type=float, default=1.0, help="Seconds between two listings of the folder")
+    parser.add_argument("--status-file", default="moonwalk_status.json", help="JSON file with the queue depth, lag and counters")
+    parser.add_argument("--export", help="JSONL file where a record of every processed image is appended")
+    parser.add_argument("--process-existing", action="store_true", help="Also process the images already in the folder")
+    parser.add_argument("--dedup", action="store_true", help="Reuse the detections of the previous image when they are near-duplicates")
+    parser.add_argument("--dedup-threshold", type=int, default=6, help="Max perceptual hash bits (of 64) that can differ")
+    parser.add_argument("--store", help="SQLite file where detection results are stored and reused (off by default)")
+    opts = parser.parse_args(args)
+
+    if not os.path.isdir(opts.folder):
+        print(f"{opts.folder} is not a folder.")
+        return
+
+    core = MoonWalkCore()
+    if opts.stub:
+        core.model = StubModel()
+        core.model_name = "stub"
+    else:
+        core.model_path = opts.model
+        core.load_model()
+    core.people_prompt = opts.class_prompt
+    core.kids_prompt = opts.subclass_prompt
+    core.max_dimension = opts.max_dimension
+    core.dedup = opts.dedup
+    core.dedup_threshold = opts.dedup_threshold
+    if opts.store:
+        core.result_store = DetectionStore(opts.store)
+    core.verbose = False
+
+    sink = JsonlSink(opts.export) if opts.export else None
+    watcher = MoonWalkWatcher(core, opts.folder, opts.queue_size, opts.policy, opts.settle_time,
+                              use_inotify=not opts.poll, poll_interval=opts.poll_interval,
+                              status_path=opts.status_file, sink=sink, process_existing=opts.process_existing)
+    try:
+        watcher.serve_forever()
+    finally:
+        if sink is not None:
+            sink.close()
+        if core.result_store is not None:
+            core.result_store.close()
+
+
+def coco_main(args):
+    from resultexport import jsonl_to_coco
+    parser = argparse.ArgumentParser(prog="main_console.py coco", description="Convert an export JSONL file to COCO JSON")
+    parser.add_argument("export", help="JSONL file written by batch --export")
+    parser.add_argument("output", help="COCO JSON file")
+    opts = parser.parse_args(args)
+
+    n_images, n_annotations = jsonl_to_coco(opts.export, opts.output)
+    print(f"Wrote {n_images} images and {n_annotations} annotations to {opts.output}")
+
+
+def invalidate_main(args):
+    from resultstore import DetectionStore
+    from utils import file_hash
+    parser = argparse.ArgumentParser(prog="main_console.py invalidate", description="Remove stored detection results")
+    parser.add_argument("--db", default="detections.sqlite", help="Path to the detection result store")
+    parser.add_argument("--image", help="Only remove the results of this image file")
+    parser.add_argument("--prompt", help="Only remove the results of this prompt")
+    parser.add_argument("--model", help="Only remove the results of this model file (matched by its file name)")
+    opts = parser.parse_args(args)
+
+    image_hash = file_hash(opts.image) if opts.image else None
+    model = os.path.basename(opts.model) if opts.model else None
+    store = DetectionStore(opts.db)
+    removed = store.invalidate(image_hash=image_hash, prompt=opts.prompt, model=model)
+    store.close()
+    print(f"Removed {removed} stored detection results.")
+
+
+def load_core_async(model_path):
+    """
+    Imports the core and loads the model on a background thread, while the user types the first paths and prompts.
+    Returns a Future with the MoonWalkCore. Nothing is printed from the thread, load errors are raised by the Future.
+    The thread is a daemon, so exiting doesn't wait for the load.
+    """
+    future = Future()
+
+    def load():
+        try:
+            from moonwalkcore import MoonWalkCore
+            core = MoonWalkCore()
+            core.model_path = model_path
+            core.load_model(announce=False)
+            future.set_result(core)
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=load, daemon=True).start()
+    return future
 
 
 def main(args):
-    model_path='models/moondream-2b-int8.mf'
+    if len(args) > 1 and args[1] == "batch":
+        batch_main(args[2:])
+        return
+    if len(args) > 1 and args[1] == "compare-tiling":
+        compare_tiling_main(args[2:])
+        return
+    if len(args) > 1 and args[1] == "serve":
+        serve_main(args[2:])
+        return
+    if len(args) > 1 and args[1] == "client":
+        client_main(args[2:])
+        return
+    if len(args) > 1 and args[1] == "pool":
+        pool_main(args[2:])
+        return
+    if len(args) > 1 and args[1] == "stream":
+        stream_main(args[2:])
+        return
+    if len(args) > 1 and args[1] == "watch":
+        watch_main(args[2:])
+        return
+    if len(args) > 1 and args[1] == "coco":
+        coco_main(args[2:])
+        return
+    if len(args) > 1 and args[1] == "invalidate":
+        invalidate_main(args[2:])
+        return
+
+    model_path=DEFAULT_MODEL_PATH
     if len(args) > 1:
         model_path = args[1]
     
     print(f"Using model path: {model_path}")
-    
+    if not os.path.exists(model_path):
+        print(f"Error: Model not found at path: {model_path}")
+        return
 
-    core = MoonWalkCore()
-    core.model_path=model_path
-    core.load_model()
+    # The first detection waits for the load
+    core_future = load_core_async(model_path)
+    core = None
+    print(f"Ready for input {process_uptime():.2f} seconds after start (loading the model in the background).")
 
     while True:
         print("======================================================")
@@ -29,14 +525,22 @@ def main(args):
         class_propmt = input("Enter the prompt for human/class detection (leave empty for 'humans'): ").strip()
         if not class_propmt:
             class_propmt = "humans"
-        core.people_prompt = class_propmt
 
         subclass_propmt = input("Enter the prompt for kids/subclass detection (leave empty for 'kids'): ").strip()
         if not subclass_propmt:
             subclass_propmt = "kids"
-        core.kids_prompt = subclass_propmt
-
 
+        if core is None:
+            start_time = time.time()
+            try:
+                core = core_future.result()
+            except Exception as e:
+                print(f"Error loading model: {str(e)}")
+                return
+            print(f"Model {core.model_name} loaded in {core.load_time:.2f} seconds "
+                  f"({time.time()-start_time:.2f} seconds waiting for it).")
+        core.people_prompt = class_propmt
+        core.kids_prompt = subclass_propmt
 
         core.run_detection(image_path=image_path)
 
@@ -0,0 +1,202 @@
+import os
+import gc
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+MODEL_EXTENSIONS = ('.mf',)
+
+
+def current_rss():
+    """Resident memory of this process in bytes, or None where /proc is not available"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def default_memory_budget():
+    """Half of the physical memory, or 4 GB where it can't be read"""
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') // 2
+    except (AttributeError, ValueError, OSError):
+        return 4 * 1024**3
+
+
+def load_moondream(path):
+    import moondream as md
+    return md.vl(model=path)
+
+
+class ModelEntry():
+    """A model file of the registry, its model if it is resident, and its stats"""
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+        self.file_size = os.path.getsize(path) if os.path.exists(path) else 0
+        self.model = None
+        self.lock = threading.Lock()
+        # Cores using the model (see ModelRegistry.get). Models in use are never evicted
+        self.users = 0
+        self.loads = 0
+        self.load_time = None
+        self.memory = None
+        self.detects = 0
+        self.detect_time = 0.0
+        self.last_used = 0.0
+
+    def memory_estimate(self):
+        """Memory measured on the last load, or the file size before the first one"""
+        return self.memory if self.memory is not None else self.file_size
+
+    def mean_detect_time(self):
+        return self.detect_time / self.detects if self.detects else None
+
+
+class ModelRegistry():
+    """
+    Registry of the models of a folder. Models are loaded the first time they are used and kept resident
+    while their memory (measured as the RSS growth of the load, or the file size before the first load)
+    fits in memory_budget; over it, the least recently used ones that no core is using are evicted.
+    Load time, memory and detect latency of every model are kept to pick the fastest one under a budget.
+
+    Args:
+    folder: Folder scanned for .mf model files
+    memory_budget: Max bytes of resident models. None for no limit
+    loader: Function that loads a model file (moondream by default)
+    """
+    def __init__(self, folder='models', memory_budget=None, loader=load_moondream):
+        self.folder = folder
+        self.memory_budget = memory_budget
+        self.loader = loader
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.evictions = 0
+        self.load_pool = None
+        self.scan()
+
+    def scan(self):
+        """Adds the model files of the folder that are not registered yet. Returns the names of every model"""
+        if os.path.isdir(self.folder):
+            for name in sorted(os.listdir(self.folder)):
+                if name.lower().endswith(MODEL_EXTENSIONS):
+                    self.add(os.path.join(self.folder, name))
+        return self.names()
+
+    def add(self, path):
+        """Registers a model file (it may be outside the folder) and returns its name"""
+        name = os.path.basename(path)
+        with self.lock:
+            if name not in self.entries:
+                self.entries[name] = ModelEntry(name, path)
+        return name
+
+    def names(self):
+        return list(self.entries)
+
+    def resident(self):
+        return [entry.name for entry in self.entries.values() if entry.model is not None]
+
+    def get(self, name, acquire=False):
+        """
+        Returns the model called name, loading it first if it is not resident.
+        With acquire, the model is marked as used (it is not evicted) until release(name) is called.
+        """
+        if name not in self.entries:
+            raise KeyError(f"Unknown model {name}. Available: {', '.join(self.names()) or 'none'}")
+        entry = self.entries[name]
+        with entry.lock:
+            entry.last_used = time.time()
+            with self.lock:
+                model = entry.model
+                if model is not None and acquire:
+                    entry.users += 1
+            if model is None:
+                # Make room first, so the peak memory stays under the budget
+                self._evict(entry.memory_estimate(), keep=name)
+                rss_before = current_rss()
+                start_time = time.time()
+                model = self.loader(entry.path)
+                entry.load_time = time.time() - start_time
+                rss_after = current_rss()
+                if rss_before is not None and rss_after is not None and rss_after > rss_before:
+                    entry.memory = rss_after - rss_before
+                with self.lock:
+                    entry.model = model
+                    if acquire:
+                        entry.users += 1
+                entry.loads += 1
+            else:
+                # Models released since the last load may have left the registry over the budget
+                self._evict(entry.memory_estimate(), keep=name)
+            return model
+
+    def release(self, name):
+        """A core stopped using a model it got with get(name, acquire=True)"""
+        with self.lock:
+            entry = self.entries.get(name)
+            if entry is not None and entry.users > 0:
+                entry.users -= 1
+
+    def load_async(self, name):
+        """Loads a model on a background thread. Returns a Future with the model"""
+        if self.load_pool is None:
+            self.load_pool = ThreadPoolExecutor(max_workers=1)
+        return self.load_pool.submit(self.get, name)
+
+    def _evict(self, needed, keep=None):
+        """
+        Evicts the least recently used resident models until needed more bytes fit in the budget.
+        Models in use are kept (a core still holds them, evicting them wouldn't free anything), even over the budget.
+        """
+        if self.memory_budget is None:
+            return
+        evicted = 0
+        with self.lock:
+            resident = [e for e in self.entries.values() if e.model is not None and e.name != keep]
+            used = sum(e.memory_estimate() for e in resident)
+            for entry in sorted((e for e in resident if e.users == 0), key=lambda e: e.last_used):
+                if used + needed <= self.memory_budget:
+                    break
+                entry.model = None
+                used -= entry.memory_estimate()
+                evicted += 1
+            self.evictions += evicted
+        if evicted:
+            gc.collect()
+
+    def record_detect(self, name, seconds):
+        with self.lock:
+            entry = self.entries.get(name)
+            if entry is not None:
+                entry.detects += 1
+                entry.detect_time += seconds
+
+    def fastest(self, memory_budget=None):
+        """
+        Name of the model with the lowest mean detect latency whose memory fits in memory_budget
+        (the registry budget by default). Models never measured go after the measured ones, smallest first.
+        """
+        budget = memory_budget if memory_budget is not None else self.memory_budget
+        candidates = [e for e in self.entries.values() if budget is None or e.memory_estimate() <= budget]
+        if not candidates:
+            raise ValueError("No model fits in the memory budget")
+        measured = [e for e in candidates if e.detects]
+        if measured:
+            return min(measured, key=lambda e: e.mean_detect_time()).name
+        return min(candidates, key=lambda e: e.memory_estimate()).name
+
+    def stats(self):
+        """A dictionary of stats per model"""
+        return {
+            entry.name: {
+                'resident': entry.model is not None,
+                'users': entry.users,
+                'loads': entry.loads,
+                'load_time': entry.load_time,
+                'memory_mb': entry.memory_estimate() / 1024**2,
+                'detects': entry.detects,
+                'mean_detect_time': entry.mean_detect_time(),
+            } for entry in self.entries.values()
+        }
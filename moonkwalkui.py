@@ -1,18 +1,38 @@
-from PyQt5.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, 
+import os
+from PyQt5.QtWidgets import (QMainWindow, QWidget, QVBoxLayout, 
                             QHBoxLayout, QLabel, QLineEdit, QPushButton, 
-                            QFileDialog, QGroupBox, QFormLayout)
-from PyQt5.QtCore import Qt
-from PyQt5.QtGui import QPixmap
+                            QFileDialog, QGroupBox, QFormLayout, QComboBox)
+from PyQt5.QtCore import Qt, QThreadPool
+from PyQt5.QtGui import QPixmap, QImage
 from moonwalkcore import MoonWalkCore
+from modelregistry import ModelRegistry, default_memory_budget
+from detectionworker import DetectionQueue, ModelLoadJob
 
 class MoonWalkUI(QMainWindow):
-    def __init__(self, model_path):
+    def __init__(self, model_path, memory_budget=None):
         super().__init__()
         self.core = MoonWalkCore()
+        # Every model next to the chosen one can be selected, and stays loaded while the resident ones fit in
+        # memory_budget bytes (half of the memory by default). Over it, the least recently used ones are evicted
+        if memory_budget is None:
+            memory_budget = default_memory_budget()
+        self.core.registry = ModelRegistry(os.path.dirname(model_path) or '.', memory_budget)
         self.core.model_path=model_path
-        self.core.load_model()
+        self.core.model_name = self.core.registry.add(model_path)
+        self.selected_model = self.core.model_name
+        # Results are shown from memory: draw on the original image and save in the background
+        self.core.render_mode='inplace'
+        self.core.async_save=True
         self.current_image_path = None
+        self.selected_image_paths = []
+        self.detection_queue = DetectionQueue(self.core, self)
+        self.detection_queue.changed.connect(self.update_queue_status)
+        # Models load on their own pool: Qt scales images on the global one, and a load there would block the GUI
+        self.model_load_pool = QThreadPool()
+        self.model_load_pool.setMaxThreadCount(1)
         self.init_ui()
+        # The window shows up while the model loads in the background. The first detection job waits for it
+        self.select_model(self.selected_model)
 
     def init_ui(self):
         """Initialization of the ui"""
@@ -28,9 +48,12 @@ class MoonWalkUI(QMainWindow):
         config_layout = QFormLayout()
 
         model_label = QLabel("Model:")
-        model_name_display = QLabel(self.core.model_name)
-        model_name_display.setStyleSheet("font-weight: bold;")
-        config_layout.addRow(model_label, model_name_display)
+        self.model_selector = QComboBox()
+        self.model_selector.addItems(self.core.registry.names())
+        self.model_selector.setCurrentText(self.core.model_name)
+        self.model_selector.setToolTip("Models are loaded in the background the first time they are selected")
+        self.model_selector.currentTextChanged.connect(self.select_model)
+        config_layout.addRow(model_label, self.model_selector)
 
         # Max Dimension
         self.max_dimension_input = QLineEdit(str(self.core.max_dimension))
@@ -64,7 +87,7 @@ class MoonWalkUI(QMainWindow):
         prompts_group.setLayout(prompts_layout)
         main_layout.addWidget(prompts_group)
 
-        select_button = QPushButton("Select Image")
+        select_button = QPushButton("Select Images")
         select_button.clicked.connect(self.select_image)
         main_layout.addWidget(select_button)
 
@@ -94,9 +117,22 @@ class MoonWalkUI(QMainWindow):
         main_layout.addLayout(images_layout)
 
         #Botón de run
+        run_layout = QHBoxLayout()
         self.run_button = QPushButton("Run Detection")
         self.run_button.clicked.connect(self.run_detection)
-        main_layout.addWidget(self.run_button)
+        run_layout.addWidget(self.run_button)
+
+        #Botón de cancelar
+        self.cancel_button = QPushButton("Cancel Pending")
+        self.cancel_button.clicked.connect(self.cancel_detection)
+        self.cancel_button.setEnabled(False)
+        run_layout.addWidget(self.cancel_button)
+        main_layout.addLayout(run_layout)
+
+        #Estado
+        self.status_label = QLabel("Ready")
+        self.status_label.setAlignment(Qt.AlignmentFlag.AlignCenter)
+        main_layout.addWidget(self.status_label)
 
         #Contadores
         counts_layout = QHBoxLayout()
@@ -140,8 +176,44 @@ class MoonWalkUI(QMainWindow):
             self.class_count_label.setText(str(0))
             self.subclass_count_label.setText(str(0))
 
+    def display_pil_image(self, image, label):
+        """
+        Display a PIL image in the specified label without going through a file.
+        The image should already be a preview of about the label size (see DetectionJob), it is converted here
+        on the main thread.
+        """
+        image = image.convert('RGB')
+        qimage = QImage(image.tobytes(), image.width, image.height, 3 * image.width, QImage.Format.Format_RGB888)
+        scaled_image = qimage.scaled(
+            label.size(),
+            Qt.AspectRatioMode.KeepAspectRatio,
+            Qt.TransformationMode.SmoothTransformation
+        )
+        label.setPixmap(QPixmap.fromImage(scaled_image))
+
+    def select_model(self, model_name):
+        """Selects the model of the next jobs and loads it in the background if it isn't resident"""
+        self.selected_model = model_name
+        if model_name in self.core.registry.resident():
+            return
+        self.status_label.setText(f"Loading {model_name}...")
+        self.status_label.setStyleSheet("")
+        job = ModelLoadJob(self.core.registry, model_name)
+        job.signals.loaded.connect(self.model_loaded)
+        job.signals.error.connect(lambda name, message: self.detection_error(name, message))
+        # Keep a reference, so the signals live until the model is loaded
+        self.model_load_job = job
+        self.model_load_pool.start(job)
+
+    def model_loaded(self, model_name, stats):
+        self.status_label.setText(f"{model_name} loaded in {stats['load_time']:.2f} seconds ({stats['memory_mb']:.0f} MB)")
+
     def validate_parameters(self):
-        """Validate all parameters before running detection"""
+        """
+        Validate all parameters before running detection.
+        Returns (max_dimension, people_prompt, kids_prompt), or None if they are not valid.
+        They are not set on the core here: a job may be using it. Every job sets them on its worker thread.
+        """
         try:
             #Max dimension is a number
             max_dim = int(self.max_dimension_input.text())
@@ -153,47 +225,79 @@ class MoonWalkUI(QMainWindow):
             if not self.kids_prompt_input.text().strip():
                 raise ValueError("Kids prompt cannot be empty")
 
-            # Update parameters
-            self.core.max_dimension = max_dim
-            self.core.people_prompt = self.people_prompt_input.text()
-            self.core.kids_prompt = self.kids_prompt_input.text()
-
-            return True
+            return max_dim, self.people_prompt_input.text(), self.kids_prompt_input.text()
 
         except ValueError as e:
-            return False
+            return None
 
     def select_image(self):
-        """Open file dialog to select an image"""
-        file_path, _ = QFileDialog.getOpenFileName(
+        """Open file dialog to select one or more images"""
+        file_paths, _ = QFileDialog.getOpenFileNames(
             self,
-            "Select Image",
+            "Select Images",
             "",
             "Image Files (*.png *.jpg *.jpeg *.gif *.bmp);;All Files (*)"
         )
         
-        if file_path:
+        if file_paths:
+            file_path = file_paths[0]
             if self.current_image_path != file_path:
                 self.load_and_display_image("", self.output_image_label)
             self.current_image_path = file_path
+            self.selected_image_paths = file_paths
             self.load_and_display_image(file_path, self.input_image_label)
 
 
     def run_detection(self):
-        """Run detection with current parameters and selected image"""
+        """Queue a detection job for every selected image with the current parameters"""
 
-        if not self.current_image_path or not self.validate_parameters():
+        parameters = self.validate_parameters()
+        if not self.selected_image_paths or parameters is None:
             return
 
-        try:
-            self.load_and_display_image("", self.output_image_label)
-            self.run_button.setText('WORKING...')
-            QApplication.processEvents()
-            result_path, n_people, n_kids = self.core.run_detection(self.current_image_path)
-            self.run_button.setText('Run Detection')
-            self.class_count_label.setText(str(n_people))
-            self.subclass_count_label.setText(str(n_kids))
-            if result_path:
-                self.load_and_display_image(result_path, self.output_image_label)
-        except Exception as e:
-            pass
\ No newline at end of file
+        max_dimension, people_prompt, kids_prompt = parameters
+        for image_path in self.selected_image_paths:
+            job = self.detection_queue.submit(
+                image_path,
+                max_dimension,
+                people_prompt,
+                kids_prompt,
+                self.selected_model,
+                max(self.output_image_label.width(), self.output_image_label.height())
+            )
+            job.signals.started.connect(self.detection_started)
+            job.signals.progress.connect(self.detection_progress)
+            job.signals.finished.connect(self.detection_finished)
+            job.signals.error.connect(self.detection_error)
+
+    def cancel_detection(self):
+        """Cancel the jobs that haven't started yet"""
+        self.detection_queue.cancel_pending()
+
+    def detection_started(self, image_path):
+        """A job started: show its input image and clean the previous result"""
+        self.current_image_path = image_path
+        self.load_and_display_image(image_path, self.input_image_label)
+        self.load_and_display_image("", self.output_image_label)
+        self.run_button.setText('WORKING...')
+        self.status_label.setStyleSheet("")
+
+    def detection_progress(self, image_path, stage):
+        self.status_label.setText(f"{os.path.basename(image_path)}: {stage}... ({len(self.detection_queue.pending)} pending)")
+
+    def detection_finished(self, image_path, result):
+        result_path, n_people, n_kids, result_image = result
+        self.class_count_label.setText(str(n_people))
+        self.subclass_count_label.setText(str(n_kids))
+        self.display_pil_image(result_image, self.output_image_label)
+        self.status_label.setText(f"{os.path.basename(image_path)}: done ({len(self.detection_queue.pending)} pending)")
+
+    def detection_error(self, image_path, message):
+        self.status_label.setText(f"{os.path.basename(image_path)}: error: {message}")
+        self.status_label.setStyleSheet("color: red;")
+
+    def update_queue_status(self, n_pending):
+        """Enable the cancel button while there are pending jobs and restore the run button when idle"""
+        self.cancel_button.setEnabled(n_pending > 0)
+        if not self.detection_queue.is_busy():
+            self.run_button.setText('Run Detection')
\ No newline at end of file
@@ -0,0 +1,293 @@
+import os
+import glob
+import time
+import queue
+import threading
+from utils import file_hash
+from resultexport import detection_record
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp')
+
+# Marks the end of the stream between stages
+_END = object()
+
+
+def collect_images(inputs):
+    """
+    Expands a list of directories, glob patterns and file paths into a sorted list of image files.
+    Args:
+    inputs: List of directories, glob patterns or file paths
+    Returns:
+    List of image paths (without duplicates, in the order of the inputs)
+    """
+    image_paths = []
+    for item in inputs:
+        if os.path.isdir(item):
+            found = sorted(
+                os.path.join(item, f) for f in os.listdir(item)
+                if f.lower().endswith(IMAGE_EXTENSIONS)
+            )
+        elif glob.has_magic(item):
+            found = sorted(f for f in glob.glob(item) if f.lower().endswith(IMAGE_EXTENSIONS))
+        else:
+            found = [item]
+        image_paths.extend(found)
+
+    seen = set()
+    return [p for p in image_paths if not (p in seen or seen.add(p))]
+
+
+class StageStats():
+    """Throughput counters of a single pipeline stage"""
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.busy_time = 0.0
+        self.errors = 0
+
+    def throughput(self):
+        """Items per second of busy time (the speed of the stage in isolation)"""
+        return self.items / self.busy_time if self.busy_time > 0 else 0.0
+
+
+class MoonWalkBatch():
+    """
+    Runs MoonWalkCore over many images as a pipeline of overlapping stages:
+    decode/resize -> encode_image -> detect -> draw/save.
+    Each stage runs on its own thread(s) and stages are connected by bounded queues,
+    so disk I/O and PIL work are hidden behind the model time.
+    If sink (a resultexport.JsonlSink) is given, a record of every processed image is appended to it.
+    """
+    def __init__(self, core, queue_size=8, decode_workers=2, save_workers=2, sink=None):
+        self.core = core
+        self.sink = sink
+        # Content hash and stage times of the images in flight, for the export records
+        self.image_info = {}
+        self.queue_size = queue_size
+        self.decode_workers = decode_workers
+        self.save_workers = save_workers
+        self.stats = {}
+        self.results = []
+        self.wall_time = 0.0
+        self.prompt_times = {}
+
+    def _stage(self, name, func, in_queue, out_queue, n_workers, ordered=False):
+        """
+        Starts n_workers threads that apply func to every item of in_queue.
+        If ordered, the results are passed on in the order of in_queue, whatever worker finishes first.
+        """
+        stats = self.stats[name]
+        lock = threading.Lock()
+        remaining = [n_workers]
+        get_lock = threading.Lock()
+        out_lock = threading.Lock()
+        # Sequence number of the next item taken, and of the next result to pass on (ordered stages)
+        received = [0]
+        next_out = [0]
+        finished = {}
+
+        def emit(seq, result):
+            if not ordered:
+                if result is not None:
+                    out_queue.put(result)
+                return
+            with out_lock:
+                # Failed items are kept as None, so the ones after them are not held back
+                finished[seq] = result
+                while next_out[0] in finished:
+                    ready = finished.pop(next_out[0])
+                    next_out[0] += 1
+                    if ready is not None:
+                        out_queue.put(ready)
+
+        def worker():
+            while True:
+                with get_lock:
+                    item = in_queue.get()
+                    seq = received[0]
+                    received[0] += 1
+                if item is _END:
+                    # Re-queue the sentinel for the sibling workers of this stage
+                    in_queue.put(_END)
+                    break
+                start_time = time.time()
+                try:
+                    result = func(item)
+                except Exception as e:
+                    result = None
+                    self.core.console.print(f"Error in {name} stage for {item[0]}: {str(e)}", style="bold red")
+                elapsed = time.time() - start_time
+                if self.sink is not None and item[0] in self.image_info:
+                    self.image_info[item[0]]['stage_times'][name] = elapsed
+                with lock:
+                    stats.busy_time += elapsed
+                    if result is None:
+                        stats.errors += 1
+                    else:
+                        stats.items += 1
+                if result is None and self.sink is not None:
+                    # The image won't reach the save stage, where its entry is removed
+                    self.image_info.pop(item[0], None)
+                emit(seq, result)
+
+            with lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                out_queue.put(_END)
+
+        threads = [threading.Thread(target=worker, daemon=True) for _ in range(n_workers)]
+        for t in threads:
+            t.start()
+        return threads
+
+    def _decode(self, item):
+        (image_path,) = item
+        orig_image, image = self.core.load_image(image_path)
+        if orig_image is None:
+            return None
+        image_hash = self.core.image_hash(image_path)
+        if self.sink is not None:
+            self.image_info[image_path] = {'hash': image_hash or file_hash(image_path), 'stage_times': {}}
+        return image_path, orig_image, image, image_hash
+
+    def _encode(self, item):
+        image_path, orig_image, image, image_hash = item
+        dedup = None
+        if self.core.dedup:
+            reference, duplicate = self.core.dedup_reference(self.core.source_key(image_path), image)
+            if duplicate:
+                # Nothing to encode: the detect stage reuses the detections of the reference.
+                # The image goes along in case the reference failed and it has to be detected after all
+                return image_path, orig_image, None, image_hash, image.size, None, None, (reference, image)
+            dedup = (reference, None)
+
+        if self.core.tiled:
+            # With a result store the tiles are encoded lazily by the detect stage, only if they are missing
+            tiles = self.core.encode_tiles(orig_image, image_hash, eager=self.core.result_store is None)
+            return image_path, orig_image, None, image_hash, image.size, tiles, None, dedup
+
+        roi = None
+        if self.core.roi_cascade:
+            roi = self.core.crosswalk_roi(self.core.source_key(image_path), orig_image, image_hash)
+            if roi is not None:
+                # The crop is detected instead of the whole image
+                crop, image, image_hash = self.core.crop_roi(orig_image, roi, image_hash)
+                roi = (roi, crop)
+
+        cache_key = self.core.cache_key(image_hash)
+        if self.core.result_store is not None and self._all_stored(image_hash, image.size):
+            # Every detection is already stored, so the image does not need to be encoded
+            encoded_image = lambda: self.core.encode_image(image, cache_key)
+        else:
+            encoded_image = self.core.encode_image(image, cache_key)
+        return image_path, orig_image, encoded_image, image_hash, image.size, None, roi, dedup
+
+    def _all_stored(self, image_hash, image_size):
+        """True if the class prompt and the prompt that follows it are both in the result store"""
+        store = self.core.result_store
+        result_people = store.get(image_hash, image_size[0], image_size[1], self.core.people_prompt, self.core.model_name)
+        if result_people is None:
+            return False
+        next_prompt = self.core.kids_prompt if result_people['objects'] else self.core.crosswalk_prompt
+        return store.get(image_hash, image_size[0], image_size[1], next_prompt, self.core.model_name) is not None
+
+    def _detect(self, item):
+        image_path, orig_image, encoded_image, image_hash, image_size, tiles, roi, dedup = item
+        img_width, img_height = orig_image.size
+        reference, duplicate_image = dedup if dedup is not None else (None, None)
+        if duplicate_image is not None and reference['detections'] is not None:
+            # The detect stage runs in order, so the reference was detected before its near-duplicates
+            return image_path, orig_image, self.core.reuse_detections(reference['detections'])
+
+        if duplicate_image is not None:
+            # The detection of the reference failed, so this image is encoded and detected here
+            detections = self.core.detect_image(orig_image, duplicate_image, image_hash,
+                                                source=self.core.source_key(image_path), dedup=False)
+        else:
+            # Boxes of a ROI crop are normalized to the crop
+            region = roi[1] if roi is not None else orig_image
+            detections = self.core.detect(encoded_image, region.size[0], region.size[1], image_hash, image_size, tiles)
+            if self.core.adaptive and tiles is None:
+                # Escalations are encoded here, on the detect thread
+                detections = self.core.escalate(region, detections, image_hash, image_size)
+            if roi is not None:
+                detections = self.core.roi_to_image(detections, roi[0], img_width, img_height)
+        if reference is not None:
+            self.core.set_dedup_detections(reference, detections)
+        for name, elapsed in detections['timings'].items():
+            total, count = self.prompt_times.get(name, (0.0, 0))
+            self.prompt_times[name] = (total + elapsed, count + 1)
+        return image_path, orig_image, detections
+
+    def _save(self, item):
+        image_path, orig_image, detections = item
+        start_time = time.time()
+        output_path = None
+        if self.core.save_results:
+            output_path = self.core.save_result(image_path, orig_image, detections)
+        if self.sink is not None:
+            info = self.image_info.pop(image_path)
+            info['stage_times']['save'] = time.time() - start_time
+            self.sink.write(detection_record(self.core, image_path, detections, info['hash'], orig_image.size,
+                                             info['stage_times'], output_path))
+        return image_path, output_path, detections['n_people'], detections['n_kids']
+
+    def run(self, image_paths):
+        """
+        Processes every image of image_paths through the pipeline.
+        Returns a list of (image_path, output_path, n_people, n_kids) in completion order.
+        """
+        self.stats = {name: StageStats(name) for name in ('decode', 'encode', 'detect', 'save')}
+        self.results = []
+        self.prompt_times = {}
+        self.image_info = {}
+
+        paths_queue = queue.Queue()
+        decoded_queue = queue.Queue(maxsize=self.queue_size)
+        encoded_queue = queue.Queue(maxsize=self.queue_size)
+        detected_queue = queue.Queue(maxsize=self.queue_size)
+        results_queue = queue.Queue()
+
+        for image_path in image_paths:
+            paths_queue.put((image_path,))
+        paths_queue.put(_END)
+
+        start_time = time.time()
+        threads = []
+        # In order, so the near-duplicate check and the ROI cache see the images in sequence
+        threads += self._stage('decode', self._decode, paths_queue, decoded_queue, self.decode_workers, ordered=True)
+        # Model stages run on a single thread each: encoding image N+1 overlaps detection on image N
+        threads += self._stage('encode', self._encode, decoded_queue, encoded_queue, 1)
+        threads += self._stage('detect', self._detect, encoded_queue, detected_queue, 1)
+        threads += self._stage('save', self._save, detected_queue, results_queue, self.save_workers)
+
+        while True:
+            result = results_queue.get()
+            if result is _END:
+                break
+            self.results.append(result)
+
+        for t in threads:
+            t.join()
+        self.core.wait_saves()
+        self.wall_time = time.time() - start_time
+        return self.results
+
+    def print_stats(self):
+        """Prints the per-stage throughput of the last run"""
+        console = self.core.console
+        console.print(f"Processed {len(self.results)} images in {self.wall_time:.2f} seconds "
+                      f"({len(self.results)/self.wall_time if self.wall_time > 0 else 0.0:.2f} images/s)", style="bold green")
+        for stats in self.stats.values():
+            console.print(f"  {stats.name:<7} {stats.items:>6} items  {stats.busy_time:8.2f} s busy  "
+                          f"{stats.throughput():8.2f} items/s  {stats.errors} errors")
+        for name, (total, count) in self.prompt_times.items():
+            console.print(f"  prompt {name:<10} {count:>6} calls  {total/count:8.3f} s mean latency")
+        if self.core.dedup:
+            console.print(f"  dedup: {self.core.dedup_skipped} of {self.core.dedup_checked} images were near-duplicates, "
+                          f"{self.core.dedup_saved_calls} model calls saved")
+        if self.core.taxonomy is not None:
+            console.print(f"  taxonomy: {self.core.taxonomy_queries} prompts run, {self.core.taxonomy_skipped} skipped")
+        if self.core.adaptive and not self.core.tiled:
+            console.print(f"  adaptive: {self.core.adaptive_summary()}")
@@ -1,76 +1,436 @@
 import os
-import moondream as md
+import shutil
 from PIL import Image
 import time
-from rich.console import Console
-from utils import detection_routine, filter_overlapping_detections, draw_bboxes
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from utils import (detection_routine, filter_overlapping_detections_np, draw_bboxes, file_hash, nms_detections, FullImage,
+                   preview_image, perceptual_hash, hamming_distance)
+from tiling import make_tiles, tile_to_image_objects
+from taxonomy import run_taxonomy
+from instrumentation import NullInstrumentation
+from imagecache import EncodedImageCache
+from modelregistry import load_moondream
+
+# Keys of the detections kept for the near-duplicates of a dedup reference
+DEDUP_KEYS = ('people', 'kids', 'adults', 'crosswalk', 'n_people', 'n_kids', 'timings', 'model_calls',
+              'taxonomy', 'roi', 'resolution', 'escalations')
+
+def lazy(func):
+    """Returns a thread-safe function that calls func the first time and then returns the same value"""
+    value = []
+    lock = threading.Lock()
+    def get():
+        with lock:
+            if not value:
+                value.append(func())
+        return value[0]
+    return get
 
 class MoonWalkCore():
     def __init__(self):
-        
-        self.console = Console()
+
+        # rich is imported when the console is first used (see console), it slows down the startup
+        self._console = None
         self.model_path=""
         self.model_name = ""
+        self.load_time = None
         self.max_dimension = 248
         self.people_prompt="humans"
         self.kids_prompt="kids"
         self.crosswalk_prompt="crosswalk"
-    
-    def load_model(self):
+        self.results_folder="result_images"
+        self.verbose=True
+
+        # Result rendering: 'full' copy, downscaled 'preview' or 'inplace' on the original image
+        self.render_mode='full'
+        self.preview_size=1024
+        # Save the result images, optionally on background threads (see wait_saves)
+        self.save_results=True
+        self.async_save=False
+        self.save_workers=2
+        self.save_pool=None
+        self.pending_saves=[]
+        self.save_lock=threading.Lock()
+
+        # Decode once, at reduced size (see fast_load_image)
+        self.fast_decode=True
+
+        # Spans and latency histograms of every stage. NullInstrumentation records nothing
+        self.instrumentation=NullInstrumentation()
+
+        # Encoded images cache, for images seen more than once (GUI, server, re-runs). Set to None to always encode,
+        # one-pass runs like batch and pool do. The counters are updated from the encode and detect threads
+        self.encode_cache=EncodedImageCache()
+        self.encode_cache_hits=0
+        self.encode_cache_misses=0
+        self.encode_cache_lock=threading.Lock()
+
+        # Persistent store of detect outputs (a resultstore.DetectionStore). Off by default, None always asks the model
+        self.result_store=None
+
+        # Dispatch every prompt at once on the shared encoding (the crosswalk one speculatively)
+        self.concurrent_prompts=False
+        self.prompt_workers=3
+        self.prompt_pool=None
+
+        # Tiled mode: detect on overlapping tiles of the original image and merge the boxes with NMS
+        self.tiled=False
+        self.tile_size=1024
+        self.tile_overlap=0.2
+        self.tile_workers=2
+        self.tile_nms_iou=0.5
+        self.tile_pool=None
+
+        # Adaptive mode: detect at the first size of resolution_ladder and only re-encode at the next ones
+        # when the result looks uncertain (see escalation_reasons). Ignored in tiled mode
+        self.adaptive=False
+        self.resolution_ladder=[248, 496, 992]
+        # Escalation rules, None/False disables each one
+        self.escalate_min_people=8
+        self.escalate_min_box_pixels=12
+        self.escalate_on_disagreement=True
+        # Adaptive stats: images run, images escalated, final resolutions and escalation reasons
+        self.adaptive_images=0
+        self.adaptive_escalated=0
+        self.adaptive_resolutions=Counter()
+        self.adaptive_reasons=Counter()
+
+        # Crosswalk ROI cascade: the crosswalk is detected once per source at roi_dimension, and the people prompts
+        # run on a crop of the original image around it (plus roi_margin of its size on every side).
+        # Ignored in tiled mode
+        self.roi_cascade=False
+        self.roi_dimension=248
+        self.roi_margin=0.3
+        self.roi_cache={}
+        self.roi_cache_hits=0
+        self.roi_cache_misses=0
+
+        # Prompt taxonomy (list of root taxonomy.TaxonomyNode) run instead of the people/kids/crosswalk prompts.
+        # Subtrees under prompts that can't matter are skipped, and the counters below show how many
+        self.taxonomy=None
+        self.taxonomy_queries=0
+        self.taxonomy_skipped=0
+
+        # Near-duplicate frame skipping: images of a source whose perceptual hash is within dedup_threshold bits
+        # of the last detected one reuse its detections instead of calling the model
+        self.dedup=False
+        self.dedup_threshold=6
+        self.dedup_references={}
+        self.dedup_checked=0
+        self.dedup_skipped=0
+        self.dedup_saved_calls=0
+
+        # modelregistry.ModelRegistry to switch between several resident models (see use_model)
+        self.registry=None
+        # Name of the registry model this core holds (acquired, so the registry doesn't evict it)
+        self.registry_model=None
+
+    @property
+    def console(self):
+        if self._console is None:
+            from rich.console import Console
+            self._console = Console()
+        return self._console
+
+    def log(self, message, style=None):
+        """Print a message on the console unless verbose output is disabled"""
+        if self.verbose:
+            self.console.print(message, style=style)
+
+    def load_model(self, announce=True):
+        """
+        Loads the model at model_path. moondream is only imported here, so importing the core is fast.
+        announce=False loads it without printing anything (errors included, they are only raised),
+        for loads running in the background while the user types.
+        """
         try:
-            self.console.print(f"Loading model {self.model_name}...", style="bold")
+            if announce:
+                self.console.print(f"Loading model {self.model_name}...", style="bold")
             start_time = time.time()
 
             self.model_name=os.path.basename(self.model_path)
             if not os.path.exists(self.model_path):
                 raise FileNotFoundError(f"Model not found at path: {self.model_path}")
-            self.model = md.vl(model=self.model_path)
-            self.console.print(f"Model {self.model_name} loaded in {time.time()-start_time:.2f} seconds.", style="bold green")
-        
+            with self.instrumentation.span('load', model=self.model_name):
+                if self.registry is not None:
+                    # Loaded through the registry, so it is kept with the other resident models
+                    self._switch_registry_model(self.registry.add(self.model_path))
+                else:
+                    self.model = load_moondream(self.model_path)
+            self.load_time = time.time() - start_time
+            if announce:
+                self.console.print(f"Model {self.model_name} loaded in {self.load_time:.2f} seconds.", style="bold green")
+
         except FileNotFoundError as e:
-            self.console.print(f"Error: {str(e)}", style="bold red")
+            if announce:
+                self.console.print(f"Error: {str(e)}", style="bold red")
             raise  # Re-raise the exception to stop execution
-            
+
         except Exception as e:
-            self.console.print(f"Error loading model: {str(e)}", style="bold red")
-            raise 
-    def run_detection(self, image_path):
+            if announce:
+                self.console.print(f"Error loading model: {str(e)}", style="bold red")
+            raise
 
-        # If file doesnt exit, new iteration
-        if not os.path.isfile(image_path):
-            print("The file does not exist. Please try again.")
+    def base_dimension(self):
+        """Max dimension images are first resized to: the first size of the ladder in adaptive mode, max_dimension otherwise"""
+        if self.adaptive and not self.tiled:
+            return min(self.resolution_ladder)
+        return self.max_dimension
+
+    def use_model(self, name):
+        """
+        Makes a model of the registry the active one, loading it first if it is not resident.
+        name 'fastest' picks the fastest model under the memory budget of the registry.
+        """
+        if self.registry is None:
+            raise ValueError("There is no model registry")
+        if name == 'fastest':
+            name = self.registry.fastest()
+        if name == self.model_name and getattr(self, 'model', None) is not None:
             return
+        self._switch_registry_model(name)
+        self.model_name = name
+        self.model_path = self.registry.entries[name].path
+        self.log(f"Using model {name}", style="bold")
 
-        # Check if valid image
+    def _switch_registry_model(self, name):
+        """
+        Acquires a model of the registry as the model of this core. The previous one is released and detached first,
+        so the registry can evict it to make room. If the load fails, the previous model is acquired again.
+        """
+        previous = self.registry_model
+        if previous is not None:
+            self.registry.release(previous)
+            self.registry_model = None
+            self.model = None
         try:
-            with Image.open(image_path) as img:
-                img.verify()
-            print("The file is a valid image.")
-        except (IOError, SyntaxError):
-            print("The file is not a valid image. Please try again.")
-
-        # Resize and encode image (for better perfomance)
-        print("Encoding image...")
-        start_time = time.time()
-        orig_image = Image.open(image_path)
+            self.model = self.registry.get(name, acquire=True)
+        except Exception:
+            if previous is not None:
+                self.model = self.registry.get(previous, acquire=True)
+                self.registry_model = previous
+            raise
+        self.registry_model = name
 
-        original_width, original_height = orig_image.size
-
-        # Resize. Max dimension=max dimension and keep original aspect ratio 
+    def target_size(self, original_width, original_height, max_dimension=None):
+        """Size of the resized image: its biggest side is max_dimension (base_dimension by default), keeping the aspect ratio"""
+        max_dimension = max_dimension or self.base_dimension()
         if original_width > original_height:
-            new_width = self.max_dimension
+            new_width = max_dimension
             new_height = int((new_width / original_width) * original_height)
         else:
-            new_height = self.max_dimension
-            new_width = int((new_height / original_height) * original_width)   
-        image = orig_image.resize((new_width, new_height))
+            new_height = max_dimension
+            new_width = int((new_height / original_height) * original_width)
+        return new_width, new_height
+
+    def resize_image(self, orig_image, max_dimension=None):
+        """Resize the image so its biggest side is max_dimension (base_dimension by default), keeping the aspect ratio"""
+        original_width, original_height = orig_image.size
 
-        encoded_image = self.model.encode_image(image)
-        print(f"Encoded in {time.time()-start_time:.2f} seconds.")
-        print("\r\r")
+        # Resize. Max dimension=max dimension and keep original aspect ratio
+        with self.instrumentation.span('resize', model=self.model_name, image_size=f"{original_width}x{original_height}"):
+            return orig_image.resize(self.target_size(original_width, original_height, max_dimension))
 
+    def fast_load_image(self, image_path):
+        """
+        Fast decode: validates and decodes the file in a single pass, at reduced size.
+        JPEGs are decoded with DCT scaling (PIL draft) to the smallest size over the target, and
+        other formats are reduced by integer factors before the final resize.
+        The original image is returned as a FullImage, only decoded at full resolution if its pixels are used.
+        """
+        with self.instrumentation.span('decode', model=self.model_name):
+            try:
+                img = Image.open(image_path)
+                original_size = img.size
+                target_size = self.target_size(*original_size)
+                img.draft('RGB', target_size)
+                img.load()
+            except (IOError, SyntaxError):
+                self.log("The file is not a valid image. Please try again.")
+                return None, None
+            self.log("The file is a valid image.")
 
-        ## Detection
+        with self.instrumentation.span('resize', model=self.model_name, image_size=f"{original_size[0]}x{original_size[1]}"):
+            # reducing_gap first reduces by an integer factor, with no visible quality loss
+            image = img.resize(target_size, reducing_gap=3.0)
+
+        # Formats without draft support were decoded at full size anyway, so keep them
+        orig_image = img if img.size == original_size else FullImage(image_path, original_size)
+        return orig_image, image
+
+    def load_image(self, image_path):
+        """
+        Decode stage: validates the file and returns the original and the resized image.
+        Returns (None, None) if the file does not exist or is not a valid image.
+        """
+
+        # If file doesnt exit, new iteration
+        if not os.path.isfile(image_path):
+            self.log("The file does not exist. Please try again.")
+            return None, None
+
+        if self.fast_decode:
+            return self.fast_load_image(image_path)
+
+        # Check if valid image
+        with self.instrumentation.span('decode', model=self.model_name):
+            try:
+                with Image.open(image_path) as img:
+                    img.verify()
+                self.log("The file is a valid image.")
+            except (IOError, SyntaxError):
+                self.log("The file is not a valid image. Please try again.")
+                return None, None
+
+            orig_image = Image.open(image_path)
+        image = self.resize_image(orig_image)
+        return orig_image, image
+
+    def image_hash(self, image_path):
+        """Content hash of an image file, used to key the caches. None if no cache is enabled"""
+        if self.encode_cache is None and self.result_store is None:
+            return None
+        return file_hash(image_path)
+
+    def cache_key(self, image_hash, max_dimension=None):
+        """Key of an image in the encoded images cache: content hash, max_dimension (base_dimension by default) and model name"""
+        if self.encode_cache is None or image_hash is None:
+            return None
+        return f"{image_hash}_{max_dimension or self.base_dimension()}_{self.model_name}"
+
+    def encode_image(self, image, cache_key=None):
+        """
+        Encode stage: runs the vision encoder once so every prompt can reuse it.
+        If cache_key is given, a previously encoded image is reused instead.
+        """
+        if self.encode_cache is not None and cache_key is not None:
+            encoded_image = self.encode_cache.get(cache_key)
+            if encoded_image is not None:
+                with self.encode_cache_lock:
+                    self.encode_cache_hits += 1
+                self.log("Encoded image found in cache.")
+                return encoded_image
+            with self.encode_cache_lock:
+                self.encode_cache_misses += 1
+
+        self.log("Encoding image...")
+        start_time = time.time()
+        with self.instrumentation.span('encode', model=self.model_name, image_size=f"{image.size[0]}x{image.size[1]}"):
+            encoded_image = self.model.encode_image(image)
+        self.log(f"Encoded in {time.time()-start_time:.2f} seconds.")
+
+        if self.encode_cache is not None and cache_key is not None:
+            self.encode_cache.put(cache_key, encoded_image)
+        return encoded_image
+
+    def detect_prompt(self, get_encoded_image, prompt, image_hash=None, image_size=None, model_calls=None, encoding=None):
+        """
+        Runs a single detect call, consulting the result store first.
+        get_encoded_image is only called (and the image only encoded) if the store misses.
+        If the model is called, encoding (what was encoded: the image, a tile...) is appended to the model_calls list.
+        """
+        use_store = self.result_store is not None and image_hash is not None and image_size is not None
+        if use_store:
+            result = self.result_store.get(image_hash, image_size[0], image_size[1], prompt, self.model_name)
+            if result is not None:
+                self.log(f"Detection of {prompt} found in result store.")
+                return result
+
+        encoded_image = get_encoded_image()
+        size_tag = f"{image_size[0]}x{image_size[1]}" if image_size is not None else ""
+        start_time = time.time()
+        with self.instrumentation.span('detect', prompt=prompt, model=self.model_name, image_size=size_tag):
+            result = detection_routine(self.model, encoded_image, prompt, time, self.verbose)
+        if self.registry is not None:
+            self.registry.record_detect(self.model_name, time.time() - start_time)
+        if model_calls is not None:
+            model_calls.append(encoding)
+
+        if use_store:
+            self.result_store.put(image_hash, image_size[0], image_size[1], prompt, self.model_name, result)
+        return result
+
+    def encode_tiles(self, orig_image, image_hash=None, eager=True, progress=None):
+        """
+        Encode stage of the tiled mode: splits the original image in overlapping tiles and resizes each one to max_dimension.
+        Returns a list of (tile, encode, tile_hash, tile_size), where encode is a lazy function that encodes the tile.
+        If eager, every tile is encoded now, in parallel on tile_workers threads.
+        """
+        img_width, img_height = orig_image.size
+        if self.tile_pool is None:
+            self.tile_pool = ThreadPoolExecutor(max_workers=self.tile_workers)
+
+        tiles = []
+        for tile in make_tiles(img_width, img_height, self.tile_size, self.tile_overlap):
+            tile_image = self.resize_image(orig_image.crop(tile))
+            tile_hash = f"{image_hash}_{'_'.join(str(c) for c in tile)}" if image_hash is not None else None
+            def encode(tile_image=tile_image, tile_hash=tile_hash):
+                if progress is not None:
+                    progress('encode')
+                return self.encode_image(tile_image, self.cache_key(tile_hash))
+            tiles.append((tile, lazy(encode), tile_hash, tile_image.size))
+
+        if eager:
+            list(self.tile_pool.map(lambda t: t[1](), tiles))
+        return tiles
+
+    def detect(self, encoded_image, img_width, img_height, image_hash=None, image_size=None, tiles=None):
+        """
+        Detection stage: runs the class, subclass and (if needed) crosswalk prompts.
+        encoded_image can also be a function that encodes the image, so nothing is encoded
+        when every prompt is found in the result store (image_hash and the resized image_size are needed for that).
+        In tiled mode, tiles (from encode_tiles) is used instead of encoded_image.
+        Returns a dictionary with the results of every prompt and the final counts.
+        'model_calls' counts the prompts that reached the model (not the result store) plus an encode for each
+        image or tile they ran on.
+        """
+
+        get_encoded_image = lazy(encoded_image) if callable(encoded_image) else (lambda: encoded_image)
+        model_calls = []
+        count_model_calls = lambda: len(model_calls) + len(set(model_calls))
+
+        def detect_tiles(prompt):
+            # Every tile is detected on its own, the boxes are mapped to the full image and the seams are merged with NMS
+            tile_results = self.tile_pool.map(
+                lambda t: self.detect_prompt(t[1], prompt, t[2], t[3], model_calls, t[0]), tiles)
+            objects = []
+            for (tile, _, _, _), tile_result in zip(tiles, tile_results):
+                objects.extend(tile_to_image_objects(tile_result['objects'], tile, img_width, img_height))
+            return nms_detections({'objects': objects}, self.tile_nms_iou, img_width, img_height)
+
+        def run_prompt(prompt):
+            # The prompt time leaves out the wait for the shared lazy encoding, which another prompt may be running.
+            # Tiles are encoded by their own detections, so in tiled mode the time still includes them
+            waited = [0.0]
+            def wait_encoded_image():
+                wait_start = time.time()
+                try:
+                    return get_encoded_image()
+                finally:
+                    waited[0] += time.time() - wait_start
+            start_time = time.time()
+            if tiles is not None:
+                result = detect_tiles(prompt)
+            else:
+                result = self.detect_prompt(wait_encoded_image, prompt, image_hash, image_size, model_calls, 'image')
+            return result, time.time() - start_time - waited[0]
+
+        if self.taxonomy is not None:
+            detections = self.detect_taxonomy(run_prompt, img_width, img_height)
+            detections['model_calls'] = count_model_calls()
+            return detections
+
+        prompts = {'people': self.people_prompt, 'kids': self.kids_prompt, 'crosswalk': self.crosswalk_prompt}
+        if self.concurrent_prompts:
+            if self.prompt_pool is None:
+                self.prompt_pool = ThreadPoolExecutor(max_workers=self.prompt_workers)
+            futures = {name: self.prompt_pool.submit(run_prompt, prompt) for name, prompt in prompts.items()}
+            get_result = lambda name: futures[name].result()
+        else:
+            get_result = lambda name: run_prompt(prompts[name])
+        timings = {}
 
         #Reset variables
         n_orig_people=0
@@ -78,71 +438,432 @@ class MoonWalkCore():
         n_adults=0
         n_kids=0
 
-        result_people=[]
-        result_kids=[]
-        result_adults=[]
-        result_crosswalk=[]
+        result_people={'objects': []}
+        result_kids={'objects': []}
+        result_adults={'objects': []}
+        result_crosswalk={'objects': []}
 
 
-        result_people = detection_routine(self.model, encoded_image, self.people_prompt, time)
+        result_people, timings['people'] = get_result('people')
         n_orig_people=len(result_people['objects'])
-        self.console.print(f"Found {n_orig_people} {self.people_prompt}", style="bold green")
-
-        print("\r\r")
+        self.log(f"Found {n_orig_people} {self.people_prompt}", style="bold green")
 
         if n_orig_people>0:
 
-            result_kids = detection_routine(self.model, encoded_image, self.kids_prompt, time)
+            result_kids, timings['kids'] = get_result('kids')
             n_kids=len(result_kids['objects'])
-            self.console.print(f"Found {n_kids} {self.kids_prompt}", style="bold green")
-
-            img_width, img_height = orig_image.size
+            self.log(f"Found {n_kids} {self.kids_prompt}", style="bold green")
 
             # Filtrar las detecciones solapadas
-            result_adults = filter_overlapping_detections(
-                result_people, 
-                result_kids,
-                iou_threshold=0.5,
-                img_width=img_width,
-                img_height=img_height
-            )
+            with self.instrumentation.span('filter', prompt=self.kids_prompt, model=self.model_name):
+                result_adults = filter_overlapping_detections_np(
+                    result_people,
+                    result_kids,
+                    iou_threshold=0.5,
+                    img_width=img_width,
+                    img_height=img_height
+                )
 
             n_adults=len(result_adults['objects'])
             n_people=n_adults+n_kids
             if(n_people>n_orig_people):
-                self.console.print(f"Detected {n_people-n_orig_people} new {self.people_prompt}")
-            self.console.print(f"Of the {n_people} {self.people_prompt}, {n_kids} seem to be {self.kids_prompt}", style="bold blue")
-            print("\r\r")
+                self.log(f"Detected {n_people-n_orig_people} new {self.people_prompt}")
+            self.log(f"Of the {n_people} {self.people_prompt}, {n_kids} seem to be {self.kids_prompt}", style="bold blue")
 
         else:
 
-            crosswalk_prompt="crosswalk"
-            result_crosswalk = detection_routine(self.model, encoded_image, crosswalk_prompt, time)
-            #print("result:")
-            #print(result_crosswalk)
+            result_crosswalk, timings['crosswalk'] = get_result('crosswalk')
             if len(result_crosswalk['objects'])==0:
-                self.console.print("There isn't even a crosswalk in the image provided!!", style="yellow bold")
+                self.log("There isn't even a crosswalk in the image provided!!", style="yellow bold")
             else:
-                print("At least there is a crosswalk in the image provided...")
-            print("\r\r")
+                self.log("At least there is a crosswalk in the image provided...")
 
-        # Dibujar los bounding boxes filtrados
-        result_image=orig_image
-        if(n_people>0):
-            result_image = draw_bboxes(
-                orig_image,
-                [result_adults, result_kids],
-                colors=[(0,0,255), (153,204,255)]
+        if self.concurrent_prompts:
+            # Speculative prompts whose result is not needed are cancelled if they haven't started. Otherwise they are
+            # waited for, so they don't hold the model during the next image, and their time is kept as <name>_speculative
+            for name, future in futures.items():
+                if name not in timings and not future.cancel():
+                    try:
+                        _, timings[f"{name}_speculative"] = future.result()
+                    except Exception:
+                        # Its result wasn't needed, so neither is its error
+                        pass
+
+        for name, elapsed in timings.items():
+            self.log(f"  {prompts.get(name, name)}: {elapsed:.2f} seconds")
+
+        return {
+            'people': result_people,
+            'kids': result_kids,
+            'adults': result_adults,
+            'crosswalk': result_crosswalk,
+            'n_people': n_people,
+            'n_kids': n_kids,
+            'timings': timings,
+            'model_calls': count_model_calls(),
+        }
+
+    def detect_taxonomy(self, run_prompt, img_width, img_height):
+        """
+        Detection stage with a taxonomy: runs the query planner of taxonomy.run_taxonomy on the shared encoding,
+        every level at once with concurrent_prompts. The results of every node are returned in 'taxonomy'.
+        The usual keys are filled from the first root: its objects as people, its children as kids, its
+        remaining objects as adults and its otherwise nodes as crosswalk, so rendering and exports work unchanged.
+        """
+        def run_level(prompts):
+            if self.concurrent_prompts and len(prompts) > 1:
+                if self.prompt_pool is None:
+                    self.prompt_pool = ThreadPoolExecutor(max_workers=self.prompt_workers)
+                return dict(zip(prompts, self.prompt_pool.map(run_prompt, prompts)))
+            return {prompt: run_prompt(prompt) for prompt in prompts}
+
+        results, timings, skipped = run_taxonomy(self.taxonomy, run_level, img_width, img_height)
+        self.taxonomy_queries += len(results)
+        self.taxonomy_skipped += skipped
+
+        for name, result in results.items():
+            self.log(f"Found {len(result['objects'])} {result['prompt']} ({result['count']} counting subclasses)", style="bold green")
+        if skipped:
+            self.log(f"Skipped {skipped} prompts that could not find anything")
+
+        root = self.taxonomy[0]
+        def merged(nodes):
+            return {'objects': [obj for node in nodes if node.name in results for obj in results[node.name]['objects']]}
+        kids = [node for node in root.children if node.name in results]
+        return {
+            'people': {'objects': results[root.name]['objects']},
+            'kids': merged(kids),
+            'adults': {'objects': results[root.name]['remaining']},
+            'crosswalk': merged(root.otherwise),
+            'n_people': results[root.name]['count'],
+            'n_kids': sum(results[node.name]['count'] for node in kids),
+            'timings': timings,
+            'taxonomy': results,
+        }
+
+    def escalation_reasons(self, detections, image_size):
+        """
+        Escalation rules of the adaptive mode. Returns the reasons why a result detected on an image of
+        image_size looks uncertain (empty if it doesn't):
+        'crowd' if at least escalate_min_people people were found,
+        'tiny_boxes' if a box is smaller than escalate_min_box_pixels in the resized image,
+        'disagreement' if some kids don't overlap any of the people (the class and subclass prompts disagree).
+        """
+        reasons = []
+        if self.escalate_min_people and detections['n_people'] >= self.escalate_min_people:
+            reasons.append('crowd')
+        if self.escalate_min_box_pixels:
+            width, height = image_size
+            for obj in detections['people']['objects'] + detections['kids']['objects']:
+                if min((obj['x_max'] - obj['x_min']) * width, (obj['y_max'] - obj['y_min']) * height) < self.escalate_min_box_pixels:
+                    reasons.append('tiny_boxes')
+                    break
+        if self.escalate_on_disagreement and detections['n_people'] > len(detections['people']['objects']):
+            reasons.append('disagreement')
+        return reasons
+
+    def escalate(self, orig_image, detections, image_hash=None, image_size=None, progress=None):
+        """
+        Coarse-to-fine step of the adaptive mode. While the detections look uncertain, the original image is
+        resized to the next size of resolution_ladder, encoded and detected again.
+        Returns the detections of the last size run, with its 'resolution', the 'escalations' made and
+        the timings of every size added up.
+        """
+        report = progress if progress is not None else (lambda stage: None)
+        img_width, img_height = orig_image.size
+        timings = dict(detections['timings'])
+        model_calls = detections['model_calls']
+        escalations = []
+
+        while True:
+            reasons = self.escalation_reasons(detections, image_size)
+            larger = [d for d in sorted(self.resolution_ladder) if d > max(image_size)]
+            if not reasons or not larger:
+                break
+            max_dimension = larger[0]
+            self.log(f"Uncertain result ({', '.join(reasons)}), escalating to {max_dimension}", style="yellow bold")
+            self.adaptive_reasons.update(reasons)
+            escalations.append({'resolution': max(image_size), 'reasons': reasons})
+
+            image = self.resize_image(orig_image, max_dimension)
+            image_size = image.size
+            def encode(image=image, max_dimension=max_dimension):
+                report('encode')
+                return self.encode_image(image, self.cache_key(image_hash, max_dimension))
+            report('detect')
+            detections = self.detect(encode, img_width, img_height, image_hash, image_size)
+            for name, elapsed in detections['timings'].items():
+                timings[name] = timings.get(name, 0.0) + elapsed
+            model_calls += detections['model_calls']
+
+        self.adaptive_images += 1
+        if escalations:
+            self.adaptive_escalated += 1
+        self.adaptive_resolutions[max(image_size)] += 1
+        detections['timings'] = timings
+        detections['model_calls'] = model_calls
+        detections['resolution'] = max(image_size)
+        detections['escalations'] = escalations
+        return detections
+
+    def source_key(self, image_path):
+        """Camera/source of an image, the key of the ROI cache and of dedup: its folder, as fixed cameras usually save their frames in one folder each"""
+        return os.path.dirname(os.path.abspath(image_path))
+
+    def crosswalk_roi(self, source, orig_image, image_hash=None):
+        """
+        Region of interest of the ROI cascade: the crosswalks found at roi_dimension, joined and grown by roi_margin.
+        Returns (left, top, right, bottom) in original pixels, or None if there is no crosswalk.
+        It is only detected the first time a source is seen, later frames of the same source reuse it.
+        """
+        if source in self.roi_cache:
+            self.roi_cache_hits += 1
+            return self.roi_cache[source]
+        self.roi_cache_misses += 1
+
+        img_width, img_height = orig_image.size
+        roi_image = self.resize_image(orig_image, self.roi_dimension)
+        encode = lazy(lambda: self.encode_image(roi_image, self.cache_key(image_hash, self.roi_dimension)))
+        result = self.detect_prompt(encode, self.crosswalk_prompt, image_hash, roi_image.size)
+
+        roi = None
+        if result['objects']:
+            x_min = min(obj['x_min'] for obj in result['objects'])
+            y_min = min(obj['y_min'] for obj in result['objects'])
+            x_max = max(obj['x_max'] for obj in result['objects'])
+            y_max = max(obj['y_max'] for obj in result['objects'])
+            margin_x = (x_max - x_min) * self.roi_margin
+            margin_y = (y_max - y_min) * self.roi_margin
+            roi = (
+                max(0, int((x_min - margin_x) * img_width)),
+                max(0, int((y_min - margin_y) * img_height)),
+                min(img_width, int(round((x_max + margin_x) * img_width))),
+                min(img_height, int(round((y_max + margin_y) * img_height))),
             )
+            if roi[2] <= roi[0] or roi[3] <= roi[1]:
+                roi = None
+        self.log(f"Crosswalk region of {source}: {roi if roi is not None else 'not found, using the whole image'}")
+        self.roi_cache[source] = roi
+        return roi
+
+    def crop_roi(self, orig_image, roi, image_hash=None):
+        """Crops the original image to the ROI and resizes the crop. Returns (crop, resized crop, crop hash)"""
+        crop = orig_image.crop(roi)
+        crop_hash = f"{image_hash}_{'_'.join(str(c) for c in roi)}" if image_hash is not None else None
+        return crop, self.resize_image(crop), crop_hash
+
+    def roi_to_image(self, detections, roi, img_width, img_height):
+        """Maps the boxes of detections run on a ROI crop back to the full image"""
+        for name in ('people', 'kids', 'adults', 'crosswalk'):
+            detections[name] = dict(detections[name])
+            detections[name]['objects'] = tile_to_image_objects(detections[name]['objects'], roi, img_width, img_height)
+        detections['roi'] = roi
+        return detections
+
+    def dedup_reference(self, source, image):
+        """
+        Near-duplicate check of the dedup mode. Returns (reference, duplicate), where reference is the entry of the
+        last image of source that was detected (its 'detections' are set once they are ready), and duplicate is True if
+        image is near-duplicate of it. Otherwise image becomes the new reference of the source.
+        Comparing against the last detected image, not the last one seen, keeps slow changes from drifting unnoticed.
+        """
+        image_phash = perceptual_hash(image)
+        self.dedup_checked += 1
+        reference = self.dedup_references.get(source)
+        if reference is not None and hamming_distance(image_phash, reference['hash']) <= self.dedup_threshold:
+            return reference, True
+        reference = {'hash': image_phash, 'detections': None}
+        self.dedup_references[source] = reference
+        return reference, False
 
+    def set_dedup_detections(self, reference, detections):
+        """
+        Keeps the detections of a dedup reference. Only the boxes, counts and timings are kept, not the rendered
+        image or any other large value, as there is a reference per source for the whole session
+        """
+        reference['detections'] = {name: detections[name] for name in DEDUP_KEYS if name in detections}
 
+    def reuse_detections(self, detections):
+        """Detections of a near-duplicate image: a copy of the reference ones, without timings as the model isn't called"""
+        self.dedup_skipped += 1
+        # Only the model calls the reference made: its results found in the result store didn't need the model
+        self.dedup_saved_calls += detections.get('model_calls', 0)
+        reused = dict(detections)
+        reused['timings'] = {}
+        reused['model_calls'] = 0
+        reused['reused'] = True
+        self.log("Near-duplicate of the previous image, reusing its detections.")
+        return reused
+
+    def adaptive_summary(self):
+        """One line with the adaptive stats: images escalated, final resolutions and escalation reasons"""
+        resolutions = ", ".join(f"{d}: {n}" for d, n in sorted(self.adaptive_resolutions.items()))
+        reasons = ", ".join(f"{r}: {n}" for r, n in self.adaptive_reasons.most_common())
+        return (f"{self.adaptive_escalated} of {self.adaptive_images} images escalated "
+                f"(final resolutions {resolutions or '-'}; reasons {reasons or '-'})")
+
+    def decode_full(self, orig_image):
+        """
+        Full-resolution PIL image of an original image. The deferred decode of a FullImage (see fast_load_image)
+        is timed on its own ('decode_full' span), so it doesn't count as drawing.
+        """
+        if not isinstance(orig_image, FullImage):
+            return orig_image
+        if not orig_image.is_loaded():
+            with self.instrumentation.span('decode_full', model=self.model_name,
+                                           image_size=f"{orig_image.size[0]}x{orig_image.size[1]}"):
+                orig_image.full()
+        return orig_image.full()
+
+    def render_result(self, orig_image, detections, mode=None):
+        """
+        Draws the filtered bounding boxes in memory and returns the result image.
+        mode (render_mode by default) is 'full' to draw on a full-resolution copy, 'preview' to draw on a copy
+        downscaled to preview_size, or 'inplace' to draw on the original image without copying it.
+        """
+        mode = mode or self.render_mode
+        if mode == 'preview':
+            orig_image = preview_image(orig_image, self.preview_size)
+        elif mode not in ('full', 'inplace'):
+            raise ValueError(f"Unknown render mode: {mode}")
+
+        # Dibujar los bounding boxes filtrados
+        result_image=orig_image
+        if(detections['n_people']>0):
+            orig_image = self.decode_full(orig_image)
+            with self.instrumentation.span('draw', model=self.model_name, image_size=f"{orig_image.size[0]}x{orig_image.size[1]}"):
+                result_image = draw_bboxes(
+                    orig_image,
+                    [detections['adults'], detections['kids']],
+                    colors=[(0,0,255), (153,204,255)],
+                    # The preview is already a copy
+                    in_place=mode != 'full'
+                )
+        return result_image
+
+    def output_path(self, image_path, tag=None):
+        """Path of the result image. tag is added to the name, to keep apart results of the same image"""
         filename=os.path.basename(image_path)
-        output_path = f"result_images/{os.path.splitext(filename)[0]}_moonwalked{os.path.splitext(filename)[1]}"
-        result_image.save(output_path)
-        print(f"Result image saved to {output_path}")
-        self.console.print(f"{self.people_prompt} bboxes: blue", style="bold blue")
-        self.console.print(f"{self.kids_prompt} bboxes: lightblue", style="bold rgb(153,204,255)")
+        suffix = f"_moonwalked_{tag}" if tag else "_moonwalked"
+        return f"{self.results_folder}/{os.path.splitext(filename)[0]}{suffix}{os.path.splitext(filename)[1]}"
+
+    def save_image(self, image_path, result_image, tag=None):
+        """Saves a rendered result image, on a background thread if async_save is set. Returns the output path"""
+        output_path = self.output_path(image_path, tag)
+
+        def save():
+            with self.instrumentation.span('save', model=self.model_name):
+                if isinstance(result_image, FullImage) and not result_image.is_loaded():
+                    # Nothing drawn: the result is the original file, no need to decode and encode it again
+                    shutil.copyfile(result_image.path, output_path)
+                else:
+                    result_image.save(output_path)
+            self.log(f"Result image saved to {output_path}")
+
+        if self.async_save:
+            if self.save_pool is None:
+                self.save_pool = ThreadPoolExecutor(max_workers=self.save_workers)
+            with self.save_lock:
+                self.pending_saves = [f for f in self.pending_saves if not f.done()]
+                self.pending_saves.append(self.save_pool.submit(save))
+        else:
+            save()
+        return output_path
+
+    def wait_saves(self):
+        """Waits for the asynchronous saves still running. Raises the first error found"""
+        with self.save_lock:
+            pending, self.pending_saves = self.pending_saves, []
+        for future in pending:
+            future.result()
 
-        return output_path, n_people, n_kids
+    def save_result(self, image_path, orig_image, detections):
+        """Save stage: draws the filtered bounding boxes and saves the result image"""
+        result_image = self.render_result(orig_image, detections)
+        return self.save_image(image_path, result_image)
 
+    def detect_image(self, orig_image, image, image_hash=None, progress=None, source=None, dedup=True):
+        """
+        Encodes (as tiles in tiled mode) and detects an image already loaded.
+        The encoding is lazy when there is a result store: it is skipped if every detection is already stored.
+        In adaptive mode, uncertain results are escalated to the next sizes of the ladder.
+        In ROI cascade mode (source is needed for it), only the crop around the crosswalk of the source is detected.
+        In dedup mode (source is needed too), near-duplicates of the last image detected reuse its detections.
+        """
+        if self.dedup and dedup and source is not None:
+            reference, duplicate = self.dedup_reference(source, image)
+            if duplicate and reference['detections'] is not None:
+                return self.reuse_detections(reference['detections'])
+            detections = self.detect_image(orig_image, image, image_hash, progress, source, dedup=False)
+            self.set_dedup_detections(reference, detections)
+            return detections
+
+        report = progress if progress is not None else (lambda stage: None)
+        img_width, img_height = orig_image.size
+        eager = self.result_store is None
+
+        if self.roi_cascade and not self.tiled and source is not None:
+            roi = self.crosswalk_roi(source, orig_image, image_hash)
+            if roi is not None:
+                crop, crop_image, crop_hash = self.crop_roi(orig_image, roi, image_hash)
+                detections = self.detect_image(crop, crop_image, crop_hash, progress)
+                return self.roi_to_image(detections, roi, img_width, img_height)
+
+        if self.tiled:
+            tiles = self.encode_tiles(orig_image, image_hash, eager, report)
+            report('detect')
+            return self.detect(None, img_width, img_height, image_hash, image.size, tiles)
+
+        def encode():
+            report('encode')
+            return self.encode_image(image, self.cache_key(image_hash))
+        encoded_image = encode() if eager else encode
+        report('detect')
+        detections = self.detect(encoded_image, img_width, img_height, image_hash, image.size)
+        if self.adaptive:
+            detections = self.escalate(orig_image, detections, image_hash, image.size, progress)
+        return detections
+
+    def process_image(self, image_path, progress=None, output_tag=None):
+        """
+        Runs the whole detection over an image and saves the result.
+        progress is an optional function called with the name of each stage when it starts
+        (decode, encode, detect, save).
+        output_tag is added to the name of the result image (see output_path).
+        The rendered image is returned in detections['result_image'] and the original size in detections['image_size'].
+        output_path is None if save_results is off.
+        Returns (output_path, detections), or (None, None) if the image can't be loaded.
+        """
+        report = progress if progress is not None else (lambda stage: None)
+
+        report('decode')
+        orig_image, image = self.load_image(image_path)
+        if orig_image is None:
+            return None, None
+
+        # Resize, encode and detect (the image is resized for better perfomance)
+        image_hash = self.image_hash(image_path)
+        detections = self.detect_image(orig_image, image, image_hash, progress, self.source_key(image_path))
+        if self.verbose:
+            print("\r\r")
+
+        report('save')
+        result_image = self.render_result(orig_image, detections)
+        detections['result_image'] = result_image
+        detections['image_size'] = orig_image.size
+        output_path = self.save_image(image_path, result_image, output_tag) if self.save_results else None
+        return output_path, detections
+
+    def run_detection(self, image_path, progress=None):
+        """
+        Runs the whole detection over an image, saves the result and prints the legend of the colors.
+        Returns (output_path, n_people, n_kids), or None if the image can't be loaded.
+        """
+        output_path, detections = self.process_image(image_path, progress)
+        if detections is None:
+            return
+
+        self.console.print(f"{self.people_prompt} bboxes: blue", style="bold blue")
+        self.console.print(f"{self.kids_prompt} bboxes: lightblue", style="bold rgb(153,204,255)")
 
+        return output_path, detections['n_people'], detections['n_kids']
@@ -0,0 +1,215 @@
+import os
+import itertools
+import collections
+import multiprocessing
+import multiprocessing.connection
+
+
+def _pin_worker(worker_id, threads_per_worker):
+    """
+    Restricts the worker to its own group of threads_per_worker cores, and tells the
+    math libraries to use that many threads. Must run before onnxruntime is imported.
+    """
+    for variable in ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS'):
+        os.environ[variable] = str(threads_per_worker)
+    if hasattr(os, 'sched_setaffinity'):
+        cores = sorted(os.sched_getaffinity(0))
+        first = (worker_id * threads_per_worker) % len(cores)
+        group = [cores[(first + i) % len(cores)] for i in range(min(threads_per_worker, len(cores)))]
+        os.sched_setaffinity(0, group)
+
+
+def _worker_main(worker_id, settings, job_queue, result_conn):
+    """Entry point of a worker process: loads its own model once and runs jobs until it gets None"""
+    _pin_worker(worker_id, settings['threads_per_worker'])
+
+    # Imported here so the model libraries see the thread settings
+    from moonwalkcore import MoonWalkCore
+    from stubmodel import StubModel
+    from resultexport import detection_record
+
+    core = MoonWalkCore()
+    # Every image is run once, and a cache per worker would multiply the memory by the number of workers
+    core.encode_cache = None
+    if settings['stub']:
+        core.model = StubModel()
+        core.model_name = "stub"
+    else:
+        core.model_path = settings['model_path']
+        core.load_model()
+    core.verbose = False
+    for name, value in settings['core'].items():
+        setattr(core, name, value)
+    result_conn.send(('ready', worker_id, None, None))
+
+    while True:
+        job = job_queue.get()
+        if job is None:
+            break
+        job_id, image_path = job
+        try:
+            output_path, detections = core.process_image(image_path)
+            if detections is None:
+                raise ValueError("The file does not exist or is not a valid image")
+            result = {
+                'image_path': image_path,
+                'output_path': output_path,
+                'n_people': detections['n_people'],
+                'n_kids': detections['n_kids'],
+                'boxes': {name: detections[name]['objects'] for name in ('people', 'kids', 'adults', 'crosswalk')},
+                'timings': detections['timings'],
+            }
+            if settings['export']:
+                # The record needs the core, so it is made here and written by the parent
+                result['record'] = detection_record(core, image_path, detections, output_path=output_path,
+                                                    image_size=detections['image_size'])
+            result_conn.send(('done', worker_id, job_id, result))
+        except Exception as e:
+            result_conn.send(('error', worker_id, job_id, {'image_path': image_path, 'error': str(e)}))
+
+
+class MoonWalkPool():
+    """
+    Process pool where every worker loads its own model once and runs whole images.
+    Every worker has its own job queue and gets its next job when it finishes the previous one, so faster
+    workers take more of them, and results are streamed back in completion order. As the pool knows which
+    job each worker holds, if a worker crashes it is restarted and its job retried.
+    Results come back through a pipe per worker, so a worker killed while sending one can't block the others.
+
+    Args:
+    model_path: Path to the moondream model loaded by every worker
+    workers: Number of worker processes
+    threads_per_worker: Cores (and math library threads) given to each worker
+    stub: Use the deterministic stub model instead of model_path
+    max_retries: Times a job is retried after crashing its worker
+    core_settings: MoonWalkCore attributes set on every worker (prompts, max_dimension...)
+    export: Add to every result the export record of the image ('record', see resultexport.detection_record)
+    """
+    def __init__(self, model_path, workers=2, threads_per_worker=1, stub=False, max_retries=2, core_settings=None,
+                 export=False):
+        self.settings = {
+            'model_path': model_path,
+            'threads_per_worker': threads_per_worker,
+            'stub': stub,
+            'core': core_settings or {},
+            'export': export,
+        }
+        self.n_workers = workers
+        self.max_retries = max_retries
+        # spawn, so the workers don't inherit the model libraries already initialized in this process
+        self.context = multiprocessing.get_context('spawn')
+        self.job_queues = {}
+        self.result_conns = {}
+        self.workers = {}
+        self.ready = set()
+        self.restarts = 0
+        # Job ids are unique across imap calls, so late results of an abandoned call are ignored
+        self.job_ids = itertools.count()
+
+    def _start_worker(self, worker_id):
+        # A new queue on every start: a worker killed while reading may leave its queue unusable
+        self.job_queues[worker_id] = self.context.Queue()
+        if worker_id in self.result_conns:
+            self.result_conns[worker_id].close()
+        result_conn, worker_conn = self.context.Pipe(duplex=False)
+        process = self.context.Process(
+            target=_worker_main,
+            args=(worker_id, self.settings, self.job_queues[worker_id], worker_conn),
+            daemon=True
+        )
+        process.start()
+        # Only the worker keeps the sending end, so its pipe reaches end of file when it dies
+        worker_conn.close()
+        self.result_conns[worker_id] = result_conn
+        self.workers[worker_id] = process
+
+    def start(self):
+        for worker_id in range(self.n_workers):
+            self._start_worker(worker_id)
+
+    def imap(self, image_paths):
+        """
+        Runs every image on the pool and yields a result dictionary per image, in completion order.
+        Failed images yield a dictionary with 'image_path' and 'error'.
+        """
+        if not self.workers:
+            self.start()
+
+        jobs = {next(self.job_ids): image_path for image_path in image_paths}
+        attempts = {job_id: 0 for job_id in jobs}
+        pending = collections.deque(jobs)
+        # Job held by each worker, recorded when it is dispatched
+        in_flight = {}
+
+        def dispatch(worker_id):
+            if pending and worker_id in self.ready and worker_id not in in_flight:
+                job_id = pending.popleft()
+                in_flight[worker_id] = job_id
+                self.job_queues[worker_id].put((job_id, jobs[job_id]))
+
+        for worker_id in list(self.ready):
+            dispatch(worker_id)
+
+        while jobs:
+            workers_by_conn = {conn: worker_id for worker_id, conn in self.result_conns.items()}
+            messages = []
+            crashed = False
+            for conn in multiprocessing.connection.wait(list(workers_by_conn), timeout=0.5):
+                try:
+                    messages.append(conn.recv())
+                except (EOFError, OSError):
+                    # The worker died, maybe halfway through a message
+                    self.workers[workers_by_conn[conn]].join(timeout=5)
+                    crashed = True
+            if crashed or not messages:
+                for failed_job in self._restart_dead_workers(in_flight):
+                    attempts[failed_job] += 1
+                    if attempts[failed_job] > self.max_retries:
+                        yield {'image_path': jobs.pop(failed_job), 'error': "Worker crashed too many times"}
+                    else:
+                        pending.appendleft(failed_job)
+                for worker_id in list(self.ready):
+                    dispatch(worker_id)
+
+            for kind, worker_id, job_id, data in messages:
+                if kind == 'ready':
+                    self.ready.add(worker_id)
+                    dispatch(worker_id)
+                    continue
+                if in_flight.get(worker_id) == job_id:
+                    del in_flight[worker_id]
+                # The next job goes out before the result is handed to the caller
+                dispatch(worker_id)
+                if job_id in jobs:
+                    del jobs[job_id]
+                    yield data
+
+    def _restart_dead_workers(self, in_flight):
+        """Restarts the workers that died and returns the jobs they were running"""
+        failed_jobs = []
+        for worker_id, process in list(self.workers.items()):
+            if process.is_alive():
+                continue
+            if worker_id not in self.ready:
+                raise RuntimeError(f"Worker {worker_id} died while loading the model (exit code {process.exitcode})")
+            self.ready.discard(worker_id)
+            if worker_id in in_flight:
+                failed_jobs.append(in_flight.pop(worker_id))
+            self.restarts += 1
+            self._start_worker(worker_id)
+        return failed_jobs
+
+    def close(self):
+        """Stops every worker after its current job"""
+        for worker_id in self.workers:
+            self.job_queues[worker_id].put(None)
+        for process in self.workers.values():
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+        for conn in self.result_conns.values():
+            conn.close()
+        self.workers = {}
+        self.job_queues = {}
+        self.result_conns = {}
+        self.ready = set()
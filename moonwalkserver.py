@@ -0,0 +1,280 @@
+import os
+import json
+import time
+import queue
+import hashlib
+import threading
+import urllib.error
+import urllib.request
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from resultexport import detection_record
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+
+
+class DetectionRequest():
+    """A detection request waiting in the server queue"""
+    def __init__(self, params):
+        self.params = params
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+        # Set when the client stopped waiting, so the model thread skips it
+        self.abandoned = False
+
+    def key(self):
+        """Requests with the same key give the same result, so they are coalesced into one run"""
+        return json.dumps(self.params, sort_keys=True)
+
+    def output_tag(self):
+        """
+        Short hash of the parameters, added to the name of the result image: requests on the same image
+        with other prompts (or max dimension, or model) don't overwrite each other's result
+        """
+        params = {name: value for name, value in self.params.items() if name != 'image_path'}
+        return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()[:8]
+
+
+class MoonWalkServer():
+    """
+    Keeps a MoonWalkCore (and its model) loaded and serves detection requests over localhost HTTP.
+
+    Requests are queued and run by a single model thread, one image per model call: there is no batching.
+    The only thing shared is exact duplicates: the thread takes windows of up to coalesce_size requests
+    (waiting at most coalesce_wait seconds for them to arrive), and identical requests of a window
+    (same image and parameters) are run only once and all get that result.
+    A client waits at most request_timeout seconds for its result (the server answers 504 after that).
+    If sink (a resultexport.JsonlSink) is given, a record of every run is appended to it.
+
+    POST /detect  {"image_path": ..., "class_prompt": ..., "subclass_prompt": ..., "max_dimension": ..., "model": ...}
+    GET  /status
+    GET  /metrics (Prometheus text, if the core has an enabled instrumentation)
+    """
+    def __init__(self, core, host=DEFAULT_HOST, port=DEFAULT_PORT, queue_size=64, coalesce_size=8, coalesce_wait=0.01,
+                 request_timeout=300, sink=None):
+        self.core = core
+        self.host = host
+        self.port = port
+        self.coalesce_size = coalesce_size
+        self.coalesce_wait = coalesce_wait
+        self.request_timeout = request_timeout
+        self.sink = sink
+        self.requests = queue.Queue(maxsize=queue_size)
+        self.processed = 0
+        # Requests run on the model, and requests answered with the result of an identical one
+        self.runs = 0
+        self.coalesced = 0
+        self.httpd = None
+        self.worker = None
+        self.running = False
+
+    def submit(self, params):
+        """
+        Queues a request and waits for its result. Raises queue.Full if the server is overloaded,
+        and TimeoutError if there is no result after request_timeout seconds
+        """
+        request = DetectionRequest(params)
+        self.requests.put_nowait(request)
+        if not request.done.wait(self.request_timeout):
+            request.abandoned = True
+            raise TimeoutError(f"No result after {self.request_timeout} seconds")
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def _next_window(self):
+        """Blocks for the first request and then gathers more until the window is full or coalesce_wait ends"""
+        window = [self.requests.get()]
+        deadline = time.time() + self.coalesce_wait
+        while len(window) < self.coalesce_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                window.append(self.requests.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return window
+
+    def _run_worker(self):
+        while self.running:
+            window = self._next_window()
+            # None is queued by stop() to wake the worker up
+            window = [request for request in window if request is not None and not request.abandoned]
+            if not window:
+                continue
+
+            groups = {}
+            for request in window:
+                groups.setdefault(request.key(), []).append(request)
+            for requests in groups.values():
+                try:
+                    result, error = self._detect(requests[0].params, requests[0].output_tag()), None
+                except Exception as e:
+                    result, error = None, e
+                for request in requests:
+                    request.result = result
+                    request.error = error
+                    request.done.set()
+            self.processed += len(window)
+            self.runs += len(groups)
+            self.coalesced += len(window) - len(groups)
+
+    def _detect(self, params, output_tag=None):
+        """Runs one request on the core with its own prompts and max dimension"""
+        if 'image_path' not in params:
+            raise ValueError("image_path is required")
+        self.core.people_prompt = params.get('class_prompt', 'humans')
+        self.core.kids_prompt = params.get('subclass_prompt', 'kids')
+        self.core.max_dimension = int(params.get('max_dimension', 248))
+        model = params.get('model')
+        if model and self.core.registry is None:
+            # Without a registry the loaded model is the only one, so it is also the fastest
+            if model not in ('fastest', self.core.model_name):
+                raise ValueError(f"Unknown model {model}: this server only has {self.core.model_name}")
+        elif model:
+            # Switching is cheap while the model stays resident in the registry
+            self.core.use_model(model)
+
+        output_path, detections = self.core.process_image(params['image_path'], output_tag=output_tag)
+        if detections is None:
+            raise ValueError(f"The file does not exist or is not a valid image: {params['image_path']}")
+        if self.sink is not None:
+            self.sink.write(detection_record(self.core, params['image_path'], detections, output_path=output_path,
+                                             image_size=detections['image_size']))
+        return {
+            # The client may run in another folder
+            'output_path': os.path.abspath(output_path) if output_path else None,
+            'n_people': detections['n_people'],
+            'n_kids': detections['n_kids'],
+            'boxes': {name: detections[name]['objects'] for name in ('people', 'kids', 'adults', 'crosswalk')},
+            'timings': detections['timings'],
+        }
+
+    def status(self):
+        return {
+            'model': self.core.model_name,
+            'queue_depth': self.requests.qsize(),
+            'processed': self.processed,
+            'runs': self.runs,
+            'coalesced': self.coalesced,
+            'models': self.core.registry.stats() if self.core.registry is not None else None,
+        }
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _reply(self, code, data):
+                body = json.dumps(data).encode()
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if self.path == "/status":
+                    self._reply(200, server.status())
+                elif self.path == "/metrics" and server.core.instrumentation.enabled:
+                    body = server.core.instrumentation.prometheus_text().encode()
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/plain; version=0.0.4")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                else:
+                    self._reply(404, {'error': f"Unknown path {self.path}"})
+
+            def do_POST(self):
+                if self.path != "/detect":
+                    self._reply(404, {'error': f"Unknown path {self.path}"})
+                    return
+                try:
+                    length = int(self.headers.get('Content-Length', 0))
+                    params = json.loads(self.rfile.read(length) or b"{}")
+                    self._reply(200, server.submit(params))
+                except queue.Full:
+                    self._reply(503, {'error': "Server queue is full"})
+                except TimeoutError as e:
+                    self._reply(504, {'error': str(e)})
+                except (ValueError, json.JSONDecodeError) as e:
+                    self._reply(400, {'error': str(e)})
+                except Exception as e:
+                    self._reply(500, {'error': str(e)})
+
+            def log_message(self, format, *args):
+                # The default handler logs every request on stderr
+                pass
+
+        return Handler
+
+    def start(self):
+        """Starts the model thread and the HTTP server in the background"""
+        self.running = True
+        self.worker = threading.Thread(target=self._run_worker, daemon=True)
+        self.worker.start()
+        self.httpd = ThreadingHTTPServer((self.host, self.port), self._make_handler())
+        # With port 0 the system chooses a free port
+        self.port = self.httpd.server_address[1]
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def serve_forever(self):
+        self.start()
+        self.core.console.print(f"Serving {self.core.model_name} on http://{self.host}:{self.port}", style="bold green")
+        try:
+            self.worker.join()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def stop(self):
+        self.running = False
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
+        try:
+            self.requests.put_nowait(None)
+        except queue.Full:
+            pass
+
+
+class MoonWalkClient():
+    """Thin client for MoonWalkServer"""
+    def __init__(self, url=f"http://{DEFAULT_HOST}:{DEFAULT_PORT}", timeout=600):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+    def _call(self, path, data=None):
+        body = json.dumps(data).encode() if data is not None else None
+        request = urllib.request.Request(self.url + path, data=body, headers={"Content-Type": "application/json"})
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            raise RuntimeError(json.loads(e.read()).get('error', str(e)))
+        except urllib.error.URLError as e:
+            raise ConnectionError(f"Can't reach the server at {self.url}: {e.reason}")
+
+    def detect(self, image_path, class_prompt="humans", subclass_prompt="kids", max_dimension=248, model=None):
+        """
+        Runs a detection on the server, with one of its models if model is given (or 'fastest').
+        Returns (output_path, n_people, n_kids, boxes), like MoonWalkCore.run_detection plus the raw boxes.
+        """
+        params = {
+            # The server may run in another folder
+            'image_path': os.path.abspath(image_path),
+            'class_prompt': class_prompt,
+            'subclass_prompt': subclass_prompt,
+            'max_dimension': max_dimension,
+        }
+        if model:
+            params['model'] = model
+        result = self._call("/detect", params)
+        return result['output_path'], result['n_people'], result['n_kids'], result['boxes']
+
+    def status(self):
+        return self._call("/status")
@@ -0,0 +1,277 @@
+import os
+import re
+import json
+import time
+import numpy as np
+from PIL import Image
+from moonwalkbatch import IMAGE_EXTENSIONS
+from utils import calculate_iou, draw_bboxes
+
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov', '.mkv', '.webm')
+
+# Classes that are tracked and drawn, with the colors of draw_bboxes in MoonWalkCore
+TRACKED_CLASSES = {'adults': (0, 0, 255), 'kids': (153, 204, 255)}
+
+
+def _natural_key(path):
+    """Sort key that orders frame_2 before frame_10"""
+    return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', os.path.basename(path))]
+
+
+def frames_from_directory(folder, fps=25.0):
+    """Yields (index, timestamp, PIL image) for the numbered frames of a folder, in numeric order"""
+    paths = sorted((os.path.join(folder, name) for name in os.listdir(folder)
+                    if name.lower().endswith(IMAGE_EXTENSIONS)), key=_natural_key)
+    for index, path in enumerate(paths):
+        with Image.open(path) as img:
+            yield index, index / fps, img.convert('RGB')
+
+
+def frames_from_video(path):
+    """Yields (index, timestamp, PIL image) for every frame of a video file. Needs opencv-python"""
+    try:
+        import cv2
+    except ImportError:
+        raise ImportError("Reading videos needs opencv-python (pip install opencv-python). "
+                          "Frame folders work without it.")
+    capture = cv2.VideoCapture(path)
+    if not capture.isOpened():
+        raise ValueError(f"Can't open the video {path}")
+    fps = capture.get(cv2.CAP_PROP_FPS) or 25.0
+    index = 0
+    try:
+        while True:
+            ok, frame = capture.read()
+            if not ok:
+                break
+            yield index, index / fps, Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+            index += 1
+    finally:
+        capture.release()
+
+
+def read_frames(source, fps=25.0):
+    """Frames of a video file or of a folder of numbered images (fps is only used for the folders)"""
+    if os.path.isdir(source):
+        return frames_from_directory(source, fps)
+    return frames_from_video(source)
+
+
+def scene_signature(frame, size=32):
+    """Tiny grayscale thumbnail used to compare consecutive frames"""
+    return np.asarray(frame.convert('L').resize((size, size)), dtype=np.float32) / 255.0
+
+
+class Track():
+    """A tracked box. Its position between detections is extrapolated with a constant velocity"""
+    def __init__(self, track_id, label, box, frame):
+        self.track_id = track_id
+        self.label = label
+        self.box = box
+        self.frame = frame
+        self.velocity = {key: 0.0 for key in box}
+        self.missed = 0
+
+    def predict(self, frame):
+        """Box expected at frame"""
+        elapsed = frame - self.frame
+        return {key: value + self.velocity[key] * elapsed for key, value in self.box.items()}
+
+    def update(self, box, frame):
+        elapsed = frame - self.frame
+        if elapsed > 0:
+            self.velocity = {key: (box[key] - self.box[key]) / elapsed for key in box}
+        self.box = box
+        self.frame = frame
+        self.missed = 0
+
+
+class IoUTracker():
+    """
+    Lightweight tracker: on every detection, each new box is matched to the live track of the same class
+    whose predicted box overlaps it most (IoU over iou_threshold, from calculate_iou). Unmatched boxes start
+    new tracks, and tracks unmatched for more than max_missed detections are dropped.
+    """
+    def __init__(self, iou_threshold=0.3, max_missed=1):
+        self.iou_threshold = iou_threshold
+        self.max_missed = max_missed
+        self.tracks = []
+        self.next_id = 1
+
+    def update(self, label, objects, frame, img_width, img_height):
+        candidates = [t for t in self.tracks if t.label == label]
+        predicted = {t.track_id: t.predict(frame) for t in candidates}
+        pairs = sorted(
+            ((calculate_iou(predicted[t.track_id], obj, img_width, img_height), t, i)
+             for t in candidates for i, obj in enumerate(objects)),
+            key=lambda pair: pair[0], reverse=True
+        )
+
+        matched_tracks, matched_objects = set(), set()
+        for iou, track, i in pairs:
+            if iou <= self.iou_threshold:
+                break
+            if track.track_id in matched_tracks or i in matched_objects:
+                continue
+            track.update(objects[i], frame)
+            matched_tracks.add(track.track_id)
+            matched_objects.add(i)
+
+        for track in candidates:
+            if track.track_id not in matched_tracks:
+                track.missed += 1
+        for i, obj in enumerate(objects):
+            if i not in matched_objects:
+                self.tracks.append(Track(self.next_id, label, obj, frame))
+                self.next_id += 1
+        self.tracks = [t for t in self.tracks if t.missed <= self.max_missed]
+
+    def boxes(self, frame):
+        """Live tracks at frame: list of (track_id, label, predicted box). Tracks missed in the last detection are left out"""
+        return [(t.track_id, t.label, t.predict(frame)) for t in self.tracks if t.missed == 0]
+
+
+class MoonWalkStream():
+    """
+    Streaming mode for videos and folders of numbered frames. Frames are read, detected or tracked and
+    written one at a time through generators, so memory does not grow with the length of the footage.
+    The full encode+detect only runs every `every` frames or when the scene changes (mean absolute difference
+    of tiny thumbnails over scene_threshold); in between, the boxes are carried by an IoUTracker.
+
+    Args:
+    core: MoonWalkCore with the model loaded
+    every: Frames between two detections
+    scene_threshold: Thumbnail difference (0-1) that forces a detection. None disables it
+    iou_threshold, max_missed: Settings of the IoUTracker
+    """
+    def __init__(self, core, every=10, scene_threshold=0.15, iou_threshold=0.3, max_missed=1):
+        self.core = core
+        self.every = every
+        self.scene_threshold = scene_threshold
+        self.tracker = IoUTracker(iou_threshold, max_missed)
+        self.frames = 0
+        self.keyframes = 0
+        self.scene_changes = 0
+        self.model_calls = 0
+        self.duration = 0.0
+        self.wall_time = 0.0
+
+    def _detect(self, source, frame):
+        """Full detection of a frame: returns the objects of every tracked class"""
+        image = self.core.resize_image(frame)
+        detections = self.core.detect_image(frame, image, source=source)
+        # An encode plus a call per prompt run, repeated on every escalation of the adaptive mode
+        self.model_calls += (1 + len(detections['timings'])) * (1 + len(detections.get('escalations', [])))
+        return {label: detections[label]['objects'] for label in TRACKED_CLASSES}
+
+    def process(self, source, fps=25.0):
+        """
+        Yields (frame image, record) for every frame of source, where record is the JSON-ready
+        dictionary of the frame: index, time, keyframe, counts and tracks.
+        """
+        self.tracker = IoUTracker(self.tracker.iou_threshold, self.tracker.max_missed)
+        last_keyframe = None
+        last_signature = None
+        for index, timestamp, frame in read_frames(source, fps):
+            img_width, img_height = frame.size
+            signature = scene_signature(frame) if self.scene_threshold is not None else None
+            scene_change = (last_signature is not None and
+                            float(np.abs(signature - last_signature).mean()) > self.scene_threshold)
+            keyframe = last_keyframe is None or index - last_keyframe >= self.every or scene_change
+            last_signature = signature
+
+            if keyframe:
+                if scene_change:
+                    # Boxes of the previous scene can't be carried over
+                    self.tracker = IoUTracker(self.tracker.iou_threshold, self.tracker.max_missed)
+                    self.scene_changes += 1
+                for label, objects in self._detect(source, frame).items():
+                    self.tracker.update(label, objects, index, img_width, img_height)
+                last_keyframe = index
+                self.keyframes += 1
+
+            tracks = self.tracker.boxes(index)
+            record = {
+                'frame': index,
+                'time': round(timestamp, 3),
+                'keyframe': keyframe,
+                'scene_change': scene_change,
+                'n_people': len(tracks),
+                'n_kids': sum(1 for _, label, _ in tracks if label == 'kids'),
+                'tracks': [{'id': track_id, 'class': label, 'box': box} for track_id, label, box in tracks],
+            }
+            self.frames += 1
+            self.duration = timestamp
+            yield frame, record
+
+    def annotate(self, frame, record):
+        """Draws the tracked boxes of a frame on it, in place"""
+        for label, color in TRACKED_CLASSES.items():
+            boxes = {'objects': [t['box'] for t in record['tracks'] if t['class'] == label]}
+            if boxes['objects']:
+                frame = draw_bboxes(frame, [boxes], colors=[color], in_place=True)
+        return frame
+
+    def run(self, source, output_path, annotated_path=None, fps=25.0):
+        """
+        Streams source to a JSONL file with a record per frame. If annotated_path is given, the frames with
+        their tracked boxes are also written there: as a video if it has a video extension (needs opencv-python),
+        or as numbered JPEGs in that folder otherwise.
+        """
+        self.frames = self.keyframes = self.scene_changes = self.model_calls = 0
+        self.duration = 0.0
+        start_time = time.time()
+        writer = None
+        try:
+            with open(output_path, 'w') as f:
+                for frame, record in self.process(source, fps):
+                    f.write(json.dumps(record) + "\n")
+                    if annotated_path is None:
+                        continue
+                    frame = self.annotate(frame, record)
+                    if writer is None:
+                        writer = _FrameWriter(annotated_path, frame.size, fps if os.path.isdir(source) else None, source)
+                    writer.write(frame, record['frame'])
+        finally:
+            if writer is not None:
+                writer.close()
+        self.wall_time = time.time() - start_time
+
+    def print_stats(self):
+        console = self.core.console
+        seconds = self.duration if self.duration > 0 else None
+        console.print(f"Processed {self.frames} frames in {self.wall_time:.2f} seconds "
+                      f"({self.frames/self.wall_time if self.wall_time > 0 else 0.0:.2f} frames/s)", style="bold green")
+        console.print(f"  {self.keyframes} detections ({self.scene_changes} on scene changes), {self.model_calls} model calls"
+                      + (f", {self.model_calls/seconds:.2f} model calls per second of footage" if seconds else ""))
+
+
+class _FrameWriter():
+    """Writes annotated frames to a video file (opencv-python) or to a folder of JPEGs"""
+    def __init__(self, path, size, fps, source):
+        self.path = path
+        self.video = None
+        if path.lower().endswith(VIDEO_EXTENSIONS):
+            try:
+                import cv2
+            except ImportError:
+                raise ImportError("Writing videos needs opencv-python (pip install opencv-python). "
+                                  "Give a folder to save the annotated frames as images.")
+            if fps is None:
+                capture = cv2.VideoCapture(source)
+                fps = capture.get(cv2.CAP_PROP_FPS) or 25.0
+                capture.release()
+            self.cv2 = cv2
+            self.video = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), fps, size)
+        else:
+            os.makedirs(path, exist_ok=True)
+
+    def write(self, frame, index):
+        if self.video is not None:
+            self.video.write(self.cv2.cvtColor(np.asarray(frame), self.cv2.COLOR_RGB2BGR))
+        else:
+            frame.save(os.path.join(self.path, f"frame_{index:06d}.jpg"), quality=90)
+
+    def close(self):
+        if self.video is not None:
+            self.video.release()
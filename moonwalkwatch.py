@@ -0,0 +1,348 @@
+import os
+import sys
+import json
+import time
+import queue
+import struct
+import select
+import threading
+from moonwalkbatch import IMAGE_EXTENSIONS
+from resultexport import detection_record
+
+# inotify flags (linux/inotify.h)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = os.O_NONBLOCK
+_EVENT_HEADER = struct.Struct('iIII')
+
+# Names used by programs while they write a file, before renaming it
+TEMPORARY_SUFFIXES = ('.tmp', '.part', '.partial', '.crdownload', '.filepart')
+
+
+def is_candidate(name):
+    """True for image files that are not hidden or temporary"""
+    lower = name.lower()
+    return not name.startswith('.') and lower.endswith(IMAGE_EXTENSIONS) and not lower.endswith(TEMPORARY_SUFFIXES)
+
+
+class PollingWatcher():
+    """Finds new or changed files by listing the folder every poll_interval seconds"""
+    name = 'polling'
+
+    def __init__(self, folder, poll_interval=1.0):
+        self.folder = folder
+        self.poll_interval = poll_interval
+        self.known = self._scan()
+        self.next_poll = 0.0
+
+    def _scan(self):
+        signatures = {}
+        for entry in os.scandir(self.folder):
+            if entry.is_file() and is_candidate(entry.name):
+                stat = entry.stat()
+                signatures[entry.path] = (stat.st_size, stat.st_mtime)
+        return signatures
+
+    def changes(self, timeout):
+        """Waits up to timeout seconds and returns the paths created or modified since the last call"""
+        wait = self.next_poll - time.time()
+        if wait > 0:
+            time.sleep(min(wait, timeout))
+            if wait > timeout:
+                return []
+        self.next_poll = time.time() + self.poll_interval
+        current = self._scan()
+        changed = [path for path, signature in current.items() if self.known.get(path) != signature]
+        self.known = current
+        return changed
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher():
+    """
+    Linux inotify through libc, so no extra package is needed. Reports files when they are closed after
+    writing or moved into the folder. Raises OSError where inotify is not available.
+    If events are not read fast enough (the block policy stops reading while the queue is full) the kernel
+    queue overflows and events are lost: then every file of the folder is reported, so none is missed.
+    """
+    name = 'inotify'
+    overflows = 0
+
+    def __init__(self, folder):
+        import ctypes
+        import ctypes.util
+        if not sys.platform.startswith('linux'):
+            raise OSError("inotify is only available on Linux")
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.folder = folder
+        self.fd = libc.inotify_init1(IN_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if libc.inotify_add_watch(self.fd, os.fsencode(folder), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, f"inotify_add_watch failed for {folder}")
+
+    def changes(self, timeout):
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return []
+        changed = []
+        overflow = False
+        offset = 0
+        while offset + _EVENT_HEADER.size <= len(data):
+            _, mask, _, length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b"\0").decode(errors='replace')
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                overflow = True
+            elif name and is_candidate(name):
+                changed.append(os.path.join(self.folder, name))
+        if overflow:
+            self.overflows += 1
+            # Files already queued are filtered out by their signature (see MoonWalkWatcher._observe)
+            changed = [entry.path for entry in os.scandir(self.folder) if entry.is_file() and is_candidate(entry.name)]
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+def make_watcher(folder, use_inotify=True, poll_interval=1.0):
+    """inotify watcher where available, polling watcher otherwise"""
+    if use_inotify:
+        try:
+            return InotifyWatcher(folder)
+        except OSError:
+            pass
+    return PollingWatcher(folder, poll_interval)
+
+
+class MoonWalkWatcher():
+    """
+    Daemon that watches a folder and runs MoonWalkCore on every new image as it appears.
+
+    A file is only queued once two observations of its size and modification time at least settle_time seconds
+    apart are the same, so partially written files are not read, and the same (path, size, mtime) is never
+    queued twice.
+    Images wait in a bounded queue for the model thread. When it is full, the 'block' policy stops
+    taking new files until there is room, and 'drop-oldest' discards the oldest waiting image.
+    The queue depth, lag and counters are written to status_path as JSON every status_interval seconds.
+
+    Args:
+    core: MoonWalkCore with the model loaded
+    folder: Folder to watch
+    queue_size: Max images waiting for the model
+    policy: 'block' or 'drop-oldest'
+    settle_time: Seconds a file must stay unchanged before it is queued
+    use_inotify: Use inotify where available (polling otherwise)
+    poll_interval: Seconds between two listings of the folder in polling mode
+    status_path: JSON status file. None disables it
+    status_interval: Seconds between two status updates
+    sink: resultexport.JsonlSink for a record of every processed image
+    process_existing: Also queue the images already in the folder at start
+    """
+    def __init__(self, core, folder, queue_size=32, policy='block', settle_time=1.0, use_inotify=True,
+                 poll_interval=1.0, status_path=None, status_interval=2.0, sink=None, process_existing=False):
+        if policy not in ('block', 'drop-oldest'):
+            raise ValueError(f"Unknown queue policy: {policy}")
+        self.core = core
+        self.folder = folder
+        self.policy = policy
+        self.settle_time = settle_time
+        self.use_inotify = use_inotify
+        self.poll_interval = poll_interval
+        self.status_path = status_path
+        self.status_interval = status_interval
+        self.sink = sink
+        self.process_existing = process_existing
+        self.images = queue.Queue(maxsize=queue_size)
+        self.put_lock = threading.Lock()
+        # Files seen but not stable yet: path -> (signature, time of the last change)
+        self.pending = {}
+        self.seen = {}
+        self.watcher = None
+        self.worker = None
+        self.running = False
+        self.started = None
+        self.queued = 0
+        self.processed = 0
+        self.dropped = 0
+        self.errors = 0
+        self.last_lag = None
+        self.max_lag = 0.0
+        self.next_status = 0.0
+
+    def _signature(self, path):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return stat.st_size, stat.st_mtime
+
+    def _observe(self, path):
+        """
+        Records a new observation of a changed file. The settle time starts again when its signature
+        differs from the last observed one
+        """
+        signature = self._signature(path)
+        if signature is None or self.seen.get(path) == signature:
+            return
+        pending = self.pending.get(path)
+        if pending is None or pending[0] != signature:
+            self.pending[path] = (signature, time.time())
+
+    def _check_pending(self):
+        """Queues the pending files whose signature is the same settle_time after it was first observed"""
+        for path, (signature, changed_at) in list(self.pending.items()):
+            # Read the clock before stat (and after it in _observe), so the two observations are never
+            # less than settle_time apart
+            now = time.time()
+            current = self._signature(path)
+            if current is None:
+                del self.pending[path]
+            elif current != signature:
+                self.pending[path] = (current, time.time())
+            elif now - changed_at >= self.settle_time and current[0] > 0:
+                del self.pending[path]
+                if self.seen.get(path) != current:
+                    self.seen[path] = current
+                    self._enqueue(path, current[1])
+
+    def _enqueue(self, path, mtime):
+        item = (path, mtime)
+        with self.put_lock:
+            if self.policy == 'block':
+                while True:
+                    if not self.running:
+                        return
+                    try:
+                        self.images.put(item, timeout=0.5)
+                        break
+                    except queue.Full:
+                        # Keep the status fresh while blocked, the queue being full is when it matters most
+                        self.write_status_if_due()
+            else:
+                while True:
+                    try:
+                        self.images.put_nowait(item)
+                        break
+                    except queue.Full:
+                        try:
+                            dropped_path, _ = self.images.get_nowait()
+                            self.dropped += 1
+                            self.core.log(f"Queue full, dropped {dropped_path}", style="yellow")
+                        except queue.Empty:
+                            pass
+            self.queued += 1
+
+    def _run_worker(self):
+        while self.running:
+            try:
+                item = self.images.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if item is None:
+                break
+            image_path, mtime = item
+            try:
+                output_path, detections = self.core.process_image(image_path)
+                if detections is None:
+                    raise ValueError("The file does not exist or is not a valid image")
+                self.last_lag = time.time() - mtime
+                self.max_lag = max(self.max_lag, self.last_lag)
+                self.processed += 1
+                self.core.console.print(f"{image_path}: {detections['n_people']} {self.core.people_prompt}, "
+                                        f"{detections['n_kids']} {self.core.kids_prompt} ({self.last_lag:.2f} s lag)")
+                if self.sink is not None:
+                    self.sink.write(detection_record(self.core, image_path, detections, output_path=output_path,
+                                                     image_size=detections['image_size']))
+            except Exception as e:
+                self.errors += 1
+                self.core.console.print(f"Error processing {image_path}: {str(e)}", style="bold red")
+
+    def status(self):
+        oldest = None
+        with self.images.mutex:
+            if self.images.queue:
+                oldest = time.time() - self.images.queue[0][1]
+        return {
+            'folder': os.path.abspath(self.folder),
+            'watcher': self.watcher.name if self.watcher is not None else None,
+            'policy': self.policy,
+            'queue_depth': self.images.qsize(),
+            'queue_size': self.images.maxsize,
+            'pending_files': len(self.pending),
+            'event_overflows': getattr(self.watcher, 'overflows', 0),
+            'queued': self.queued,
+            'processed': self.processed,
+            'dropped': self.dropped,
+            'errors': self.errors,
+            'near_duplicates': self.core.dedup_skipped,
+            'model_calls_saved': self.core.dedup_saved_calls,
+            'oldest_queued_age': oldest,
+            'last_lag': self.last_lag,
+            'max_lag': self.max_lag,
+            'uptime': time.time() - self.started if self.started else 0.0,
+            'updated': time.time(),
+        }
+
+    def write_status(self):
+        """Writes the status file atomically, so readers never see it half written"""
+        if self.status_path is None:
+            return
+        tmp_path = self.status_path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.status(), f, indent=2)
+        os.replace(tmp_path, self.status_path)
+
+    def write_status_if_due(self):
+        if time.time() >= self.next_status:
+            self.write_status()
+            self.next_status = time.time() + self.status_interval
+
+    def start(self):
+        self.running = True
+        self.started = time.time()
+        self.watcher = make_watcher(self.folder, self.use_inotify, self.poll_interval)
+        if self.process_existing:
+            for entry in os.scandir(self.folder):
+                if entry.is_file() and is_candidate(entry.name):
+                    self._observe(entry.path)
+        self.worker = threading.Thread(target=self._run_worker, daemon=True)
+        self.worker.start()
+
+    def serve_forever(self):
+        """Watches the folder until interrupted"""
+        self.start()
+        self.core.console.print(f"Watching {self.folder} ({self.watcher.name}, {self.policy} queue of {self.images.maxsize})",
+                                style="bold green")
+        try:
+            while self.running:
+                # Short timeouts while files are settling, so they are queued soon after
+                timeout = min(self.settle_time, 0.2) if self.pending else 1.0
+                for path in self.watcher.changes(timeout):
+                    self._observe(path)
+                self._check_pending()
+                self.write_status_if_due()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def stop(self):
+        self.running = False
+        if self.watcher is not None:
+            self.watcher.close()
+            self.watcher = None
+        if self.worker is not None:
+            self.worker.join(timeout=10)
+        self.write_status()
@@ -0,0 +1,162 @@
+import os
+import json
+import time
+import threading
+from utils import file_hash
+
+# COCO categories of the exported boxes (the people boxes are split in adults and kids)
+COCO_CATEGORIES = [
+    {'id': 1, 'name': 'adults'},
+    {'id': 2, 'name': 'kids'},
+    {'id': 3, 'name': 'crosswalk'},
+]
+
+
+def detection_record(core, image_path, detections, image_hash=None, image_size=None, stage_times=None, output_path=None):
+    """
+    Export record of a processed image: source path, content hash, prompts, model, every box
+    (normalized 0-1) and the timings of the prompts and of the pipeline stages.
+    """
+    record = {
+        'path': os.path.abspath(image_path),
+        'hash': image_hash or file_hash(image_path),
+        'width': image_size[0] if image_size else None,
+        'height': image_size[1] if image_size else None,
+        'model': core.model_name,
+        'prompts': {'class': core.people_prompt, 'subclass': core.kids_prompt, 'crosswalk': core.crosswalk_prompt},
+        'max_dimension': detections.get('resolution', core.base_dimension()),
+        'n_people': detections['n_people'],
+        'n_kids': detections['n_kids'],
+        'boxes': {name: detections[name]['objects'] for name in ('people', 'kids', 'adults', 'crosswalk')},
+        'prompt_times': detections['timings'],
+        'stage_times': stage_times or {},
+        'output_path': output_path,
+        'finished': time.time(),
+    }
+    if detections.get('taxonomy') is not None:
+        record['taxonomy'] = {name: {'prompt': result['prompt'], 'objects': result['objects'], 'count': result['count']}
+                              for name, result in detections['taxonomy'].items()}
+    if detections.get('roi') is not None:
+        record['roi'] = list(detections['roi'])
+    return record
+
+
+class JsonlSink():
+    """
+    Append-only JSONL file of export records, safe to write from several threads.
+    The file is flushed and fsynced every fsync_every records or fsync_interval seconds, so a crash
+    loses at most those. A record cut in half by a crash is removed when the file is opened again.
+
+    Args:
+    path: JSONL file. Existing records are kept
+    fsync_every: Records between two fsyncs
+    fsync_interval: Max seconds between two fsyncs
+    """
+    def __init__(self, path, fsync_every=100, fsync_interval=5.0):
+        self.path = path
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self.lock = threading.Lock()
+        self.written = 0
+        self.unsynced = 0
+        self.last_sync = time.time()
+        self._drop_partial_line()
+        self.file = open(path, 'a')
+
+    def _drop_partial_line(self):
+        """Truncates the file after its last complete line"""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb+') as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            if size == 0:
+                return
+            f.seek(size - 1)
+            if f.read(1) == b"\n":
+                return
+            # Look back for the end of the last complete line
+            position = size
+            while position > 0:
+                step = min(65536, position)
+                position -= step
+                f.seek(position)
+                chunk = f.read(step)
+                newline = chunk.rfind(b"\n")
+                if newline >= 0:
+                    f.truncate(position + newline + 1)
+                    return
+            f.truncate(0)
+
+    def finished_paths(self):
+        """Absolute source paths already in the file, to resume a run"""
+        paths = set()
+        with self.lock:
+            self.file.flush()
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        paths.add(json.loads(line)['path'])
+                    except (ValueError, KeyError):
+                        continue
+        return paths
+
+    def write(self, record):
+        line = json.dumps(record) + "\n"
+        with self.lock:
+            self.file.write(line)
+            self.written += 1
+            self.unsynced += 1
+            if self.unsynced >= self.fsync_every or time.time() - self.last_sync >= self.fsync_interval:
+                self._sync()
+
+    def _sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+        self.last_sync = time.time()
+
+    def close(self):
+        with self.lock:
+            if not self.file.closed:
+                self._sync()
+                self.file.close()
+
+
+def jsonl_to_coco(jsonl_path, coco_path):
+    """
+    Converts an export JSONL file to a COCO detection JSON (pixel [x, y, width, height] boxes).
+    Adults, kids and crosswalks are exported as three categories. If an image appears more than once
+    (re-runs), its last record is used. Returns the number of images and annotations written.
+    """
+    records = {}
+    with open(jsonl_path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            records[record['path']] = record
+
+    images, annotations = [], []
+    for image_id, record in enumerate(records.values(), start=1):
+        width, height = record['width'], record['height']
+        images.append({'id': image_id, 'file_name': record['path'], 'width': width, 'height': height})
+        for category in COCO_CATEGORIES:
+            for obj in record['boxes'][category['name']]:
+                x = obj['x_min'] * width
+                y = obj['y_min'] * height
+                w = (obj['x_max'] - obj['x_min']) * width
+                h = (obj['y_max'] - obj['y_min']) * height
+                annotations.append({
+                    'id': len(annotations) + 1,
+                    'image_id': image_id,
+                    'category_id': category['id'],
+                    'bbox': [x, y, w, h],
+                    'area': w * h,
+                    'iscrowd': 0,
+                })
+
+    with open(coco_path, 'w') as f:
+        json.dump({'images': images, 'annotations': annotations, 'categories': COCO_CATEGORIES}, f)
+    return len(images), len(annotations)
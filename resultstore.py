@@ -0,0 +1,128 @@
+import json
+import time
+import sqlite3
+import threading
+
+
+class DetectionStore():
+    """
+    Persistent memo of model.detect outputs, stored in a local SQLite file.
+    Results are keyed by image hash, resized dimensions, prompt and model name. The model name is the basename
+    of the model file, not a hash of its contents: after replacing a model file with another one of the same name,
+    invalidate its results.
+    When the stored results go over max_bytes, the least recently used ones are evicted.
+    Hits don't write to the database: their last use is kept in memory and written with the next put
+    (or every touch_batch hits, or on close), so a lookup never waits for a commit.
+
+    Args:
+    db_path: Path to the SQLite file
+    max_bytes: Size budget for the stored results (serialized JSON bytes)
+    touch_batch: Hits kept in memory before their last use is written
+    """
+    def __init__(self, db_path="detections.sqlite", max_bytes=256 * 1024**2, touch_batch=256):
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self.touch_batch = touch_batch
+        self.hits = 0
+        self.misses = 0
+        self.connection = None
+        self.lock = threading.Lock()
+        # Last use of the results read since the last write, by key
+        self.touched = {}
+
+    def _connect(self):
+        """Opens the database the first time it is needed"""
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.db_path, check_same_thread=False)
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS detections (
+                    image_hash TEXT NOT NULL,
+                    width INTEGER NOT NULL,
+                    height INTEGER NOT NULL,
+                    prompt TEXT NOT NULL,
+                    model TEXT NOT NULL,
+                    result TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    last_used REAL NOT NULL,
+                    PRIMARY KEY (image_hash, width, height, prompt, model)
+                )""")
+            self.connection.commit()
+        return self.connection
+
+    def _write_touched(self, db):
+        """Writes the last use of the results read since the last write. The caller holds the lock and commits"""
+        if self.touched:
+            db.executemany(
+                "UPDATE detections SET last_used=? WHERE image_hash=? AND width=? AND height=? AND prompt=? AND model=?",
+                [(last_used,) + key for key, last_used in self.touched.items()])
+            self.touched = {}
+
+    def get(self, image_hash, width, height, prompt, model):
+        """Returns the stored detect output, or None if it is not in the store"""
+        with self.lock:
+            db = self._connect()
+            key = (image_hash, width, height, prompt, model)
+            row = db.execute(
+                "SELECT result FROM detections WHERE image_hash=? AND width=? AND height=? AND prompt=? AND model=?",
+                key).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.touched[key] = time.time()
+            if len(self.touched) >= self.touch_batch:
+                self._write_touched(db)
+                db.commit()
+            self.hits += 1
+            return json.loads(row[0])
+
+    def put(self, image_hash, width, height, prompt, model, result):
+        """Stores a detect output and evicts the least recently used results over the budget"""
+        data = json.dumps(result)
+        with self.lock:
+            db = self._connect()
+            # The eviction below needs the last uses up to date
+            self._write_touched(db)
+            db.execute(
+                "INSERT OR REPLACE INTO detections VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (image_hash, width, height, prompt, model, data, len(data), time.time()))
+            total = db.execute("SELECT COALESCE(SUM(size), 0) FROM detections").fetchone()[0]
+            if total > self.max_bytes:
+                rows = db.execute("SELECT rowid, size FROM detections ORDER BY last_used").fetchall()
+                evicted = []
+                for rowid, size in rows:
+                    if total <= self.max_bytes:
+                        break
+                    evicted.append((rowid,))
+                    total -= size
+                db.executemany("DELETE FROM detections WHERE rowid=?", evicted)
+            db.commit()
+
+    def invalidate(self, image_hash=None, prompt=None, model=None):
+        """
+        Removes the stored results that match every given filter.
+        Without filters the whole store is cleared.
+        Returns the number of removed results.
+        """
+        conditions = []
+        params = []
+        for column, value in (('image_hash', image_hash), ('prompt', prompt), ('model', model)):
+            if value is not None:
+                conditions.append(f"{column}=?")
+                params.append(value)
+        query = "DELETE FROM detections"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+
+        with self.lock:
+            db = self._connect()
+            removed = db.execute(query, params).rowcount
+            db.commit()
+        return removed
+
+    def close(self):
+        with self.lock:
+            if self.connection is not None:
+                self._write_touched(self.connection)
+                self.connection.commit()
+                self.connection.close()
+                self.connection = None
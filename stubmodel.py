@@ -0,0 +1,51 @@
+import time
+import random
+import hashlib
+
+
+class StubEncodedImage():
+    """Encoded image of the stub model: just a hash of the pixels"""
+    def __init__(self, digest, size):
+        self.digest = digest
+        self.size = size
+
+
+class StubModel():
+    """
+    Deterministic stand-in for a moondream model, for running the server, the benchmarks and the
+    pipelines without the .mf weights. The same image and prompt always give the same boxes.
+
+    Args:
+    encode_time: Seconds that encode_image sleeps, to simulate the model cost
+    detect_time: Seconds that each detect call sleeps
+    max_objects: Maximum number of boxes returned by detect
+    """
+    def __init__(self, encode_time=0.0, detect_time=0.0, max_objects=5):
+        self.encode_time = encode_time
+        self.detect_time = detect_time
+        self.max_objects = max_objects
+
+    def encode_image(self, image):
+        if isinstance(image, StubEncodedImage):
+            return image
+        if self.encode_time:
+            time.sleep(self.encode_time)
+        digest = hashlib.sha256(image.convert('RGB').tobytes()).hexdigest()
+        return StubEncodedImage(digest, image.size)
+
+    def detect(self, image, object):
+        encoded_image = self.encode_image(image)
+        if self.detect_time:
+            time.sleep(self.detect_time)
+        rng = random.Random(f"{encoded_image.digest}_{object}")
+        objects = []
+        for _ in range(rng.randint(0, self.max_objects)):
+            x_min = rng.uniform(0.0, 0.85)
+            y_min = rng.uniform(0.0, 0.7)
+            objects.append({
+                'x_min': x_min,
+                'y_min': y_min,
+                'x_max': x_min + rng.uniform(0.03, 0.15),
+                'y_max': y_min + rng.uniform(0.1, 0.3),
+            })
+        return {'objects': objects}
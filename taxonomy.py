@@ -0,0 +1,120 @@
+import os
+import json
+from utils import filter_overlapping_children
+
+
+class TaxonomyNode():
+    """
+    A prompt of a taxonomy. children are only queried if this prompt finds objects, and otherwise
+    (like the crosswalk fallback) only if it finds none.
+
+    Args:
+    prompt: Detect prompt
+    name: Unique name of the node in the results (the prompt by default)
+    children: Subclasses of this prompt. Their objects are removed from this one with the IoU filter
+    otherwise: Nodes queried when this prompt finds nothing
+    iou_threshold: IoU over which an object of this node is considered the same as one of its children
+    """
+    def __init__(self, prompt, name=None, children=(), otherwise=(), iou_threshold=0.5):
+        self.prompt = prompt
+        self.name = name or prompt
+        self.children = list(children)
+        self.otherwise = list(otherwise)
+        self.iou_threshold = iou_threshold
+
+    @classmethod
+    def from_dict(cls, data):
+        if isinstance(data, str):
+            return cls(data)
+        if 'prompt' not in data:
+            raise ValueError(f"Taxonomy node without prompt: {data}")
+        return cls(
+            data['prompt'],
+            data.get('name'),
+            [cls.from_dict(child) for child in data.get('children', [])],
+            [cls.from_dict(node) for node in data.get('otherwise', [])],
+            data.get('iou_threshold', 0.5),
+        )
+
+    def walk(self):
+        """This node and every node under it"""
+        yield self
+        for node in self.children + self.otherwise:
+            yield from node.walk()
+
+
+def load_taxonomy(path):
+    """
+    Loads a taxonomy from a JSON or YAML file (YAML needs PyYAML). The file holds a node or a list of root nodes:
+    {"prompt": ..., "name": ..., "children": [...], "otherwise": [...], "iou_threshold": ...}, where a node
+    can also be just its prompt as a string. Returns the list of root nodes.
+    """
+    with open(path) as f:
+        if os.path.splitext(path)[1].lower() in ('.yaml', '.yml'):
+            try:
+                import yaml
+            except ImportError:
+                raise ImportError("YAML taxonomies need PyYAML (pip install pyyaml). JSON ones work without it.")
+            data = yaml.safe_load(f)
+        else:
+            data = json.load(f)
+
+    roots = [TaxonomyNode.from_dict(node) for node in (data if isinstance(data, list) else [data])]
+    names = [node.name for root in roots for node in root.walk()]
+    duplicated = {name for name in names if names.count(name) > 1}
+    if duplicated:
+        raise ValueError(f"Repeated taxonomy node names: {', '.join(sorted(duplicated))}. Give them a name")
+    return roots
+
+
+def count_nodes(nodes):
+    return sum(1 for root in nodes for _ in root.walk())
+
+
+def run_taxonomy(roots, run_level, img_width, img_height):
+    """
+    Query planner of a taxonomy. Nodes are queried level by level, so the prompts of a level can run at once on
+    the shared encoding; the children of a node that found nothing (or its otherwise nodes, if it found something)
+    are never queried. Then every parent is resolved against all its children: the parent objects overlapping a
+    child object are removed ('remaining'), and 'count' is the remaining objects plus the counts of the children.
+
+    Args:
+    roots: Root TaxonomyNodes
+    run_level: Function that runs a list of prompts and returns {prompt: (result, seconds)}
+    Returns:
+    ({name: {'prompt', 'objects', 'remaining', 'count'}} of the nodes queried, {name: seconds}, number of nodes skipped)
+    """
+    results = {}
+    timings = {}
+    skipped = 0
+    level = list(roots)
+    while level:
+        answers = run_level(list(dict.fromkeys(node.prompt for node in level)))
+        next_level = []
+        for node in level:
+            result, timings[node.name] = answers[node.prompt]
+            results[node.name] = {'prompt': node.prompt, 'objects': result['objects']}
+            if result['objects']:
+                next_level += node.children
+                skipped += count_nodes(node.otherwise)
+            else:
+                next_level += node.otherwise
+                skipped += count_nodes(node.children)
+        level = next_level
+
+    def resolve(node):
+        result = results[node.name]
+        children = [child for child in node.children if child.name in results]
+        for child in children:
+            resolve(child)
+        for other in node.otherwise:
+            if other.name in results:
+                resolve(other)
+        remaining = filter_overlapping_children(
+            result, [results[child.name] for child in children], node.iou_threshold, img_width, img_height)
+        result['remaining'] = remaining['objects']
+        result['count'] = len(result['remaining']) + sum(results[child.name]['count'] for child in children)
+
+    for root in roots:
+        resolve(root)
+    return results, timings, skipped
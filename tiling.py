@@ -0,0 +1,91 @@
+import time
+from utils import boxes_to_array, iou_matrix
+
+
+def make_tiles(width, height, tile_size, overlap):
+    """
+    Splits an image of width x height pixels into overlapping square tiles.
+    Args:
+    width, height: Dimensions of the original image
+    tile_size: Side of each tile in original pixels
+    overlap: Fraction of the tile shared with the next one, at least 0 and below 1
+    Returns:
+    List of tiles (left, top, right, bottom) that cover the whole image
+    """
+    if not 0 <= overlap < 1:
+        # 1 or more would step one pixel at a time, and a negative overlap would leave gaps between tiles
+        raise ValueError(f"Tile overlap must be at least 0 and below 1, got {overlap}")
+
+    def positions(length):
+        if length <= tile_size:
+            return [(0, length)]
+        step = max(1, int(tile_size * (1 - overlap)))
+        starts = list(range(0, length - tile_size, step))
+        # The last tile is aligned with the border of the image
+        starts.append(length - tile_size)
+        return [(start, start + tile_size) for start in starts]
+
+    return [(left, top, right, bottom)
+            for top, bottom in positions(height)
+            for left, right in positions(width)]
+
+
+def tile_to_image_objects(objects, tile, img_width, img_height):
+    """
+    Maps detections normalized to a tile back to coordinates normalized to the full image.
+    """
+    left, top, right, bottom = tile
+    tile_width = right - left
+    tile_height = bottom - top
+    return [{
+        'x_min': (left + obj['x_min'] * tile_width) / img_width,
+        'y_min': (top + obj['y_min'] * tile_height) / img_height,
+        'x_max': (left + obj['x_max'] * tile_width) / img_width,
+        'y_max': (top + obj['y_max'] * tile_height) / img_height,
+    } for obj in objects]
+
+
+def compare_tiling(core, image_paths, iou_threshold=0.5):
+    """
+    Runs every image with one big resize and with tiles, and returns a list of dictionaries with
+    the time, the number of people and kids of each mode, and the fraction of the one-resize
+    people boxes that are also found by the tiled mode.
+    The caches are disabled while comparing so both modes really run the model.
+    """
+    saved = core.tiled, core.encode_cache, core.result_store
+    core.encode_cache = None
+    core.result_store = None
+    rows = []
+    try:
+        for image_path in image_paths:
+            row = {'image': image_path}
+            people = {}
+            for tiled in (False, True):
+                mode = 'tiled' if tiled else 'resize'
+                core.tiled = tiled
+                orig_image, image = core.load_image(image_path)
+                if orig_image is None:
+                    break
+                start_time = time.time()
+                detections = core.detect_image(orig_image, image)
+                row[f'{mode}_time'] = time.time() - start_time
+                row[f'{mode}_people'] = detections['n_people']
+                row[f'{mode}_kids'] = detections['n_kids']
+                people[mode] = detections['people']['objects']
+            else:
+                img_width, img_height = orig_image.size
+                if people['resize']:
+                    matched = 0
+                    if people['tiled']:
+                        iou = iou_matrix(
+                            boxes_to_array(people['resize'], img_width, img_height),
+                            boxes_to_array(people['tiled'], img_width, img_height)
+                        )
+                        matched = int((iou.max(axis=1) > iou_threshold).sum())
+                    row['agreement'] = matched / len(people['resize'])
+                else:
+                    row['agreement'] = 1.0 if not people['tiled'] else 0.0
+                rows.append(row)
+    finally:
+        core.tiled, core.encode_cache, core.result_store = saved
+    return rows
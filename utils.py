@@ -1,7 +1,43 @@
-from PIL import ImageDraw
+import hashlib
+import threading
+import numpy as np
+from PIL import Image, ImageDraw
 
+# Con menos boxes que esto el bucle de Python es más rápido que numpy (ver benchmark_iou.py)
+NUMPY_MIN_BOXES = 10
 
-def detection_routine(model, image, whatiwant, time):
+
+class FullImage():
+    """
+    Imagen original que solo se decodifica a resolución completa cuando se usan sus píxeles.
+    size está disponible sin decodificar; cualquier otro atributo (copy, crop, save...) se delega
+    en la imagen PIL completa, que se carga la primera vez.
+    """
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self.image = None
+        self.lock = threading.Lock()
+
+    def is_loaded(self):
+        return self.image is not None
+
+    def full(self):
+        """Devuelve la imagen PIL a resolución completa, decodificándola si hace falta"""
+        with self.lock:
+            if self.image is None:
+                image = Image.open(self.path)
+                image.load()
+                self.image = image
+        return self.image
+
+    def __getattr__(self, name):
+        # Only called for attributes that FullImage doesn't have
+        if name in ('path', 'size', 'image', 'lock'):
+            raise AttributeError(name)
+        return getattr(self.full(), name)
+
+def detection_routine(model, image, whatiwant, time, verbose=True):
     """
     Runs a detection routine using the provided model on the given image.
     Args:
@@ -9,15 +45,33 @@ def detection_routine(model, image, whatiwant, time):
         image: The image on which detection is to be performed.
         whatiwant: The specific object or feature to detect in the image.
         time: A module or object that provides the current time (typically the `time` module).
+        verbose: If False, the progress messages are not printed.
     Returns:
         The result of the detection performed by the model.
     """
-    print("Detecting...")
+    if verbose:
+        print("Detecting...")
     start_time = time.time()
     result = model.detect(image, whatiwant)  
-    print(f"Detected in {time.time()-start_time:.2f} seconds.")
+    if verbose:
+        print(f"Detected in {time.time()-start_time:.2f} seconds.")
     return result
 
+def file_hash(path, chunk_size=1024 * 1024):
+    """
+    Returns the SHA-256 hex digest of the contents of a file.
+    Args:
+        path: Path to the file.
+        chunk_size: Bytes read on each step, so big images are not loaded at once.
+    Returns:
+        The hex digest of the file contents.
+    """
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
 def calculate_iou(box1, box2, img_width, img_height):
     """
     Calcula el IoU (Intersection over Union) entre dos bounding boxes.
@@ -100,18 +154,154 @@ def filter_overlapping_detections(global_results, subclass_results, iou_threshol
     
     return globalfiltered_results
 
-def draw_bboxes(image, detections_list, colors=None):
+def boxes_to_array(objects, img_width, img_height):
+    """
+    Convierte una lista de detecciones normalizadas (0-1) en un array Nx4 de coordenadas en píxeles.
+    Columnas: x_min, y_min, x_max, y_max
+    """
+    if not objects:
+        return np.zeros((0, 4), dtype=np.float64)
+    boxes = np.array(
+        [[obj['x_min'], obj['y_min'], obj['x_max'], obj['y_max']] for obj in objects],
+        dtype=np.float64
+    )
+    return boxes * np.array([img_width, img_height, img_width, img_height], dtype=np.float64)
+
+def iou_matrix(boxes1, boxes2):
+    """
+    Calcula la matriz de IoU entre dos arrays de bounding boxes (Nx4 y Mx4) en una sola operación.
+    Devuelve un array NxM con los mismos valores que calculate_iou para cada pareja.
+    """
+    x_min_inter = np.maximum(boxes1[:, None, 0], boxes2[None, :, 0])
+    y_min_inter = np.maximum(boxes1[:, None, 1], boxes2[None, :, 1])
+    x_max_inter = np.minimum(boxes1[:, None, 2], boxes2[None, :, 2])
+    y_max_inter = np.minimum(boxes1[:, None, 3], boxes2[None, :, 3])
+
+    # Solo hay intersección si las dos dimensiones son positivas
+    overlaps = (x_min_inter < x_max_inter) & (y_min_inter < y_max_inter)
+    intersection = np.where(overlaps, (x_max_inter - x_min_inter) * (y_max_inter - y_min_inter), 0.0)
+
+    boxes1_area = (boxes1[:, 2] - boxes1[:, 0]) * (boxes1[:, 3] - boxes1[:, 1])
+    boxes2_area = (boxes2[:, 2] - boxes2[:, 0]) * (boxes2[:, 3] - boxes2[:, 1])
+    union = boxes1_area[:, None] + boxes2_area[None, :] - intersection
+
+    iou = np.zeros_like(intersection)
+    np.divide(intersection, union, out=iou, where=overlaps & (union > 0))
+    return iou
+
+def filter_overlapping_detections_np(global_results, subclass_results, iou_threshold=0.5, img_width=None, img_height=None,
+                                     min_boxes=NUMPY_MIN_BOXES):
+    """
+    Versión vectorizada de filter_overlapping_detections, con el mismo resultado.
+    Las coordenadas se convierten a arrays una sola vez y la matriz de IoU se calcula de golpe.
+    Con menos de min_boxes boxes en total se usa el bucle, que para pocas boxes es más rápido.
+    """
+    global_objects = global_results['objects']
+    subclass_objects = subclass_results['objects']
+    if len(global_objects) + len(subclass_objects) < min_boxes:
+        return filter_overlapping_detections(global_results, subclass_results, iou_threshold, img_width, img_height)
+
+    globalfiltered_results = {key: value for key, value in global_results.items() if key != 'objects'}
+    if not global_objects or not subclass_objects:
+        globalfiltered_results['objects'] = list(global_objects)
+        return globalfiltered_results
+
+    iou = iou_matrix(
+        boxes_to_array(global_objects, img_width, img_height),
+        boxes_to_array(subclass_objects, img_width, img_height)
+    )
+    keep = ~(iou > iou_threshold).any(axis=1)
+    globalfiltered_results['objects'] = [obj for obj, k in zip(global_objects, keep) if k]
+    return globalfiltered_results
+
+def filter_overlapping_children(parent_results, children_results, iou_threshold=0.5, img_width=None, img_height=None):
+    """
+    Generalización de filter_overlapping_detections a varias subclases: quita de parent_results
+    las detecciones que se solapan con alguna detección de cualquiera de los hijos.
+    """
+    children_objects = [obj for results in children_results for obj in results['objects']]
+    return filter_overlapping_detections_np(parent_results, {'objects': children_objects}, iou_threshold, img_width, img_height)
+
+def non_max_suppression(boxes, iou_threshold=0.5, scores=None):
+    """
+    NMS voraz sobre un array Nx4 de bounding boxes.
+    Sin scores (moondream no los devuelve) se da prioridad a las boxes en el orden recibido.
+    Devuelve los índices de las boxes que se mantienen.
+    """
+    order = np.arange(len(boxes)) if scores is None else np.argsort(-np.asarray(scores), kind='stable')
+    if len(boxes) == 0:
+        return []
+
+    iou = iou_matrix(boxes, boxes)
+    suppressed = np.zeros(len(boxes), dtype=bool)
+    keep = []
+    for i in order:
+        if suppressed[i]:
+            continue
+        keep.append(int(i))
+        suppressed |= iou[i] > iou_threshold
+    return keep
+
+def nms_detections(results, iou_threshold=0.5, img_width=1, img_height=1, min_boxes=NUMPY_MIN_BOXES):
+    """
+    Aplica NMS a un diccionario de detecciones y devuelve otro con las boxes que se mantienen.
+    Con menos de min_boxes boxes se usa un bucle con calculate_iou en vez de la matriz de numpy.
+    """
+    filtered_results = {key: value for key, value in results.items() if key != 'objects'}
+    objects = results['objects']
+    if len(objects) < min_boxes:
+        kept = []
+        for obj in objects:
+            if all(calculate_iou(obj, other, img_width, img_height) <= iou_threshold for other in kept):
+                kept.append(obj)
+        filtered_results['objects'] = kept
+        return filtered_results
+
+    keep = non_max_suppression(boxes_to_array(objects, img_width, img_height), iou_threshold)
+    filtered_results['objects'] = [objects[i] for i in keep]
+    return filtered_results
+
+def perceptual_hash(image, hash_size=8):
+    """
+    Hash perceptual (dHash) de una imagen: compara cada píxel con su vecino en una miniatura en grises
+    de (hash_size+1) x hash_size. Imágenes casi iguales dan hashes a poca distancia de Hamming.
+    """
+    pixels = np.asarray(image.convert('L').resize((hash_size + 1, hash_size), Image.BILINEAR), dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int(''.join('1' if bit else '0' for bit in bits), 2)
+
+def hamming_distance(hash1, hash2):
+    """Número de bits distintos entre dos hashes"""
+    return bin(hash1 ^ hash2).count('1')
+
+def preview_image(image, max_size):
+    """
+    Devuelve una copia reducida de la imagen cuyo lado mayor es como mucho max_size.
+    Si la imagen es una FullImage sin cargar, se decodifica directamente a tamaño reducido (draft).
+    """
+    if isinstance(image, FullImage) and not image.is_loaded():
+        preview = Image.open(image.path)
+        preview.draft('RGB', (max_size, max_size))
+        preview.load()
+    else:
+        preview = image.full() if isinstance(image, FullImage) else image
+        preview = preview.copy()
+    preview.thumbnail((max_size, max_size))
+    return preview
+
+def draw_bboxes(image, detections_list, colors=None, in_place=False):
     """
     Dibuja múltiples grupos de bounding boxes sobre una imagen.
     Args:
     image: PIL Image o ruta a la imagen
     detections_list: Lista de diccionarios con detecciones
     colors: Lista de colores RGB para cada grupo de detecciones
+    in_place: Si es True se dibuja sobre la propia imagen, sin copiarla
     Returns:
     PIL Image con todos los bboxes dibujados
     """
     # Crear una copia para no modificar la original
-    image_with_boxes = image.copy()
+    image_with_boxes = image if in_place else image.copy()
     draw = ImageDraw.Draw(image_with_boxes)
     
     # Obtener dimensiones de la imagen